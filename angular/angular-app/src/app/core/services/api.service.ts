@@ -726,7 +726,7 @@ export class ApiService {
 
   public getReportingObligationsView(id: string): Observable<string> {
     return this.http
-      .get<string>(`${this.API_RO_URL}/ros/document/${id}`)
+      .get(`${this.API_RO_URL}/ros/document/${id}`, { responseType: 'text' })
   }
 
 
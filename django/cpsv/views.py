@@ -3,7 +3,6 @@ import logging as logger
 import os
 
 # Create your views here.
-import requests
 from rest_framework import filters, permissions
 from rest_framework.generics import RetrieveUpdateDestroyAPIView
 from rest_framework.pagination import LimitOffsetPagination
@@ -19,6 +18,7 @@ from cpsv.rdf_call import (
 )
 from cpsv.rdf_call import get_public_service_uris_filter
 from cpsv.serializers import PublicServiceSerializer, ContactPointSerializer
+from searchapp.clients import get_http_session
 
 RDF_FUSEKI_URL = os.environ["RDF_FUSEKI_URL"]
 URI_IS_CLASSIFIED_BY = os.environ["URI_IS_CLASSIFIED_BY"]
@@ -223,5 +223,5 @@ class FusekiDatasetAPIView(APIView):
 
         req_data = {"query": request.data["query"]}
 
-        r = requests.post(RDF_FUSEKI_URL, data=req_data)
+        r = get_http_session('fuseki').post(RDF_FUSEKI_URL, data=req_data)
         return Response(r.content)
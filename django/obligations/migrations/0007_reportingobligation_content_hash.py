@@ -0,0 +1,67 @@
+import hashlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def content_hash(ro):
+    return hashlib.sha256((ro.name + "\0" + ro.definition).encode("utf-8")).hexdigest()
+
+
+def merge_duplicate(apps, keep_id, duplicate_id):
+    # move everything pointing to the duplicate to the oldest row with the same content
+    for model_name, field in (('ReportingObligationOffsets', 'ro_id'), ('Comment', 'reporting_obligation_id'),
+                              ('Tag', 'reporting_obligation_id')):
+        apps.get_model('obligations', model_name).objects.filter(**{field: duplicate_id}).update(**{field: keep_id})
+
+    # acceptance states are unique per user and per model, the states of the kept row win
+    AcceptanceState = apps.get_model('obligations', 'AcceptanceState')
+    kept_states = AcceptanceState.objects.filter(reporting_obligation_id=keep_id)
+    users = set(kept_states.exclude(user_id=None).values_list('user_id', flat=True))
+    probability_models = set(kept_states.exclude(probability_model=None).values_list('probability_model', flat=True))
+    AcceptanceState.objects.filter(reporting_obligation_id=duplicate_id).exclude(
+        user_id__in=users).exclude(probability_model__in=probability_models).update(reporting_obligation_id=keep_id)
+
+    ReportingObligation = apps.get_model('obligations', 'ReportingObligation')
+    duplicate = ReportingObligation.objects.get(pk=duplicate_id)
+    if duplicate.rdf_id:
+        ReportingObligation.objects.filter(pk=keep_id, rdf_id=None).update(rdf_id=duplicate.rdf_id)
+    duplicate.delete()
+
+
+def fill_content_hash(apps, schema_editor):
+    ReportingObligation = apps.get_model('obligations', 'ReportingObligation')
+    kept = {}
+    duplicates = []
+    batch = []
+    for ro in ReportingObligation.objects.order_by('id').only('id', 'name', 'definition').iterator():
+        ro.content_hash = content_hash(ro)
+        if ro.content_hash in kept:
+            duplicates.append((kept[ro.content_hash], ro.id))
+            continue
+        kept[ro.content_hash] = ro.id
+        batch.append(ro)
+        if len(batch) == BATCH_SIZE:
+            ReportingObligation.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    ReportingObligation.objects.bulk_update(batch, ['content_hash'])
+
+    for keep_id, duplicate_id in duplicates:
+        merge_duplicate(apps, keep_id, duplicate_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obligations', '0006_reportingobligationoffsets_roannotationworklog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportingobligation',
+            name='content_hash',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(fill_content_hash, migrations.RunPython.noop),
+    ]
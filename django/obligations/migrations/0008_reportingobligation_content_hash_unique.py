@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obligations', '0007_reportingobligation_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportingobligation',
+            name='content_hash',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
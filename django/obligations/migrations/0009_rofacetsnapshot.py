@@ -0,0 +1,25 @@
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obligations', '0008_reportingobligation_content_hash_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ROFacetSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_version', models.CharField(max_length=64, unique=True)),
+                ('facets', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
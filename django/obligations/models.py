@@ -1,3 +1,6 @@
+import hashlib
+
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.utils import timezone
 from django.db.models import Q
@@ -7,10 +10,16 @@ from searchapp.models import Document
 
 # Create your models here.
 
+def reporting_obligation_hash(name, definition):
+    return hashlib.sha256((name + "\0" + definition).encode("utf-8")).hexdigest()
+
+
 class ReportingObligation(models.Model):
     rdf_id = models.CharField(max_length=200, null=True)
     name = models.TextField()
     definition = models.TextField()
+    # name and definition are unindexed text, rows are looked up by the hash of both
+    content_hash = models.CharField(max_length=64, unique=True, editable=False)
 
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
@@ -21,6 +30,10 @@ class ReportingObligation(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.content_hash = reporting_obligation_hash(self.name, self.definition)
+        super(ReportingObligation, self).save(*args, **kwargs)
+
 
 class ReportingObligationOffsets(models.Model):
     ro = models.ForeignKey(ReportingObligation, on_delete=models.CASCADE)
@@ -99,3 +112,14 @@ class Tag(models.Model):
 
     def __str__(self):
         return self.value
+
+
+class ROFacetSnapshot(models.Model):
+    # the RO dropdown options, rebuilt when the dataset version changes, see obligations.rdf_call
+    dataset_version = models.CharField(max_length=64, unique=True)
+    facets = JSONField(default=list)
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
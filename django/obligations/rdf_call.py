@@ -1,11 +1,13 @@
 from SPARQLWrapper import SPARQLWrapper, JSON
+import hashlib
 import json
 import logging as logger
 import os
 from typing import List, Tuple
 
+from django.db.models import Count, Max
 
-from obligations.models import ReportingObligation
+from obligations.models import ReportingObligation, ROFacetSnapshot
 from obligations import build_rdf
 from obligations.build_rdf import D_ENTITIES, ExampleCasContent, ROGraph
 from obligations.rdf_parser import SPARQLReportingObligationProvider, RDFLibGraphWrapper, SPARQLGraphWrapper
@@ -15,6 +17,14 @@ URL_FUSEKI = os.environ['RDF_FUSEKI_URL']
 graph_wrapper = SPARQLGraphWrapper(URL_FUSEKI)
 ro_provider = SPARQLReportingObligationProvider(graph_wrapper)
 
+FACET_ENTITIES_FIRST = ["http://dgfisma.com/reporting_obligations/hasReporter",
+                        "http://dgfisma.com/reporting_obligations/hasPropMod",
+                        "http://dgfisma.com/reporting_obligations/hasVerb",
+                        "http://dgfisma.com/reporting_obligations/hasReport",
+                        "http://dgfisma.com/reporting_obligations/hasRegulatoryBody",
+                        "http://dgfisma.com/reporting_obligations/hasPropTmp"
+                        ]
+
 
 def rdf_get_name_of_entity(entity):
     entity_dict = {
@@ -55,6 +65,78 @@ def rdf_get_predicate(predicate):
     return ro_provider.get_all_from_type(predicate)
 
 
+def rdf_get_entity_facets():
+    """
+    The entities with their options for the RO dropdowns, from one SPARQL query.
+    """
+    entity_values = {}
+    for entity, value in ro_provider.get_entity_values():
+        values = entity_values.setdefault(entity, [])
+        if value is not None:
+            values.append(value)
+
+    arr = []
+    for entity, values in entity_values.items():
+        entity_name = rdf_get_name_of_entity(entity)
+        # TODO: Currently not supporting "Entity" in RDF
+        if "Entity" in entity_name:
+            continue
+        options = [{"name": entity_name, "code": ""}]
+        for option in sorted(values):
+            options.append({"name": option, "code": option})
+        arr.append({"entity": entity, "options": options})
+
+    arr.sort(key=lambda x: x['options'][0]['name'])
+
+    # who, what and when come first
+    arr_whowhatwhen = []
+    for s_ent in FACET_ENTITIES_FIRST:
+        for facet in arr:
+            if facet['entity'] == s_ent:
+                arr_whowhatwhen.append(arr.pop(arr.index(facet)))
+                break
+
+    return arr_whowhatwhen + arr
+
+
+def ro_dataset_version():
+    """
+    Changes whenever reporting obligations are added or updated, every RO ingest touches updated_at.
+    """
+    stats = ReportingObligation.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    return hashlib.sha256(f"{stats['count']}:{stats['updated_at']}".encode("utf-8")).hexdigest()
+
+
+def build_ro_facet_snapshot():
+    """
+    Store the RO facets for the current dataset version, unless they are already stored.
+    Snapshots created before it are removed, a snapshot built at the same time by another worker is kept.
+    """
+    dataset_version = ro_dataset_version()
+    snapshot = ROFacetSnapshot.objects.filter(dataset_version=dataset_version).first()
+    if snapshot is None:
+        snapshot, _ = ROFacetSnapshot.objects.get_or_create(
+            dataset_version=dataset_version, defaults={'facets': rdf_get_entity_facets()})
+        ROFacetSnapshot.objects.filter(created_at__lt=snapshot.created_at).delete()
+        logger.info("Built RO facet snapshot for dataset version %s", dataset_version)
+    return snapshot
+
+
+def get_ro_facets():
+    """
+    The facets of the snapshot of the current dataset version, shared by all users.
+    Rebuilt when the ROs changed since the last snapshot, e.g. by a save outside the pipeline.
+    """
+    try:
+        snapshot = build_ro_facet_snapshot()
+    except Exception:
+        snapshot = ROFacetSnapshot.objects.first()
+        if snapshot is None:
+            raise
+        logger.exception("Failed to rebuild the RO facet snapshot, serving the one of %s", snapshot.created_at)
+    return snapshot.facets
+
+
 # Test this in the console
 def rdf_get_all_reporting_obligations():
     return ro_provider.get_all_ro_str()
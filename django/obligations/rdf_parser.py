@@ -119,6 +119,38 @@ class SPARQLReportingObligationProvider:
 
         return l_entity_predicates
 
+    def get_entity_values(self) -> List[Tuple[str, str]]:
+        """ All entity predicates with their distinct values in one grouped query.
+        Returns:
+            List of (predicate URI, value), value is None for a predicate without values.
+        """
+        q = f"""
+            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+            PREFIX dgfro: <{build_rdf.RO_BASE}>
+            SELECT ?pred ?value
+            WHERE {{
+                ?pred rdfs:domain dgfro:ReportingObligation .
+                ?pred rdfs:range ?entClass .
+
+            FILTER ( EXISTS {{ ?entClass rdfs:subClassOf skos:Concept . }} ||
+                ?entClass = skos:Concept
+            )
+            FILTER EXISTS {{ ?_ro rdf:type dgfro:ReportingObligation . }}
+
+                OPTIONAL {{
+                    ?ro ?pred ?ent .
+                    ?ent skos:prefLabel ?value
+                }}
+            }}
+            GROUP BY ?pred ?value
+        """
+
+        l = self.graph_wrapper.query(q)
+
+        return [(row['pred']['value'], row['value']['value'] if 'value' in row else None) for row in l]
+
     def get_all_from_type(self, type_uri,
                           distinct=True) -> List[str]:
         """
@@ -1,18 +1,17 @@
 import datetime
-import logging as logger
 import os
 
+from django.core.cache import cache
 from django.db.models import Q
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from django.views.decorators.vary import vary_on_cookie
-from minio import Minio
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from minio.error import NoSuchKey
 from rest_framework import permissions, filters, status
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView, RetrieveUpdateAPIView
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_204_NO_CONTENT
+from rest_framework.status import HTTP_204_NO_CONTENT
 from rest_framework.views import APIView
 
 from obligations.models import ROAnnotationWorklog, ReportingObligationOffsets
@@ -21,8 +20,9 @@ from obligations.serializers import ROAnnotationWorklogSerializer, ReportingObli
 from obligations.serializers import ReportingObligationSerializer, AcceptanceStateSerializer, CommentSerializer, \
     TagSerializer
 from searchapp.permissions import IsOwner, IsOwnerOrSuperUser
+from searchapp.clients import get_minio
 from .rdf_call import rdf_get_available_entities, rdf_get_predicate, \
-    rdf_get_all_reporting_obligations, rdf_query_predicate_multiple_id, rdf_get_name_of_entity
+    rdf_get_all_reporting_obligations, rdf_query_predicate_multiple_id, get_ro_facets
 
 # Annotation API consants
 
@@ -30,6 +30,15 @@ ANNOTATION_STORE_METADATA = '{"message": "Annotator Store API","links": {}}'
 KWARGS_RO_ID_KEY = 'ro_id'
 KWARGS_DOCUMENT_ID_KEY = 'document_id'
 
+RO_HTML_BUCKET = "ro-html-output"
+RO_HTML_CONTENT_TYPE = "text/html; charset=utf-8"
+EXTRACT_RO_NLP_VERSION = os.environ.get('EXTRACT_RO_NLP_VERSION', 'd16bba97890')
+# RO html up to this size is kept in the Django cache, larger documents are streamed from MinIO.
+# The default cache is file based with MAX_ENTRIES 1000, which bounds it to about 500 MB on disk
+RO_HTML_CACHE_MAX_BYTES = int(os.environ.get('RO_HTML_CACHE_MAX_BYTES', 512 * 1024))
+RO_HTML_CACHE_TIMEOUT = int(os.environ.get('RO_HTML_CACHE_TIMEOUT', 60 * 60))
+RO_HTML_STREAM_CHUNK_BYTES = 64 * 1024
+
 class PaginationHandlerMixin(object):
     @property
     def paginator(self):
@@ -78,47 +87,8 @@ class ReportingObligationEntityMapAPIView(APIView):
     pagination_class = SmallResultsSetPagination
     queryset = ReportingObligation.objects.none()
 
-    @method_decorator(cache_page(60 * 60 * 2))
-    @method_decorator(vary_on_cookie)
     def get(self, request, format=None):
-
-        all_entities = rdf_get_available_entities()
-        arr = []
-
-        for entity in all_entities:
-
-            # TODO: Currently not supporting "Entity" in RDF
-            if not "Entity" in rdf_get_name_of_entity(entity):
-
-                entity_name = rdf_get_name_of_entity(entity)
-                options = [{"name": entity_name, "code": ""}]
-                for option in sorted(rdf_get_predicate(entity)):
-                    options.append({"name": option, "code": option})
-                item = {"entity": entity, "options": options}
-                arr.append(item)
-
-        arr.sort(key=lambda x: x['options'][0]['name'])
-
-        arr_whowhatwhen = [None for _ in range(5)]
-
-        l_entities = ["http://dgfisma.com/reporting_obligations/hasReporter",
-                      "http://dgfisma.com/reporting_obligations/hasPropMod",
-                      "http://dgfisma.com/reporting_obligations/hasVerb",
-                      "http://dgfisma.com/reporting_obligations/hasReport",
-                      "http://dgfisma.com/reporting_obligations/hasRegulatoryBody",
-                      "http://dgfisma.com/reporting_obligations/hasPropTmp"
-                      ]
-
-        arr_whowhatwhen = []
-        for s_ent in l_entities:
-            for filter in arr:
-                if filter['entity'] == s_ent:
-                    arr_whowhatwhen.append(arr.pop(arr.index(filter)))
-                    break
-
-        arr = arr_whowhatwhen + arr
-
-        return Response(arr)
+        return Response(get_ro_facets())
 
 
 class ReportingObligationListAPIView(ListCreateAPIView):
@@ -358,19 +328,56 @@ class ReportingObligationDocumentHtmlAPIView(APIView):
     #permission_classes = [permissions.IsAuthenticated, IsOwnerOrSuperUser]
 
     def get(self, request, document_id, format=None):
-
-        minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                             secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
-        bucket_name = "ro-html-output"
-
-        EXTRACT_RO_NLP_VERSION = os.environ.get(
-            'EXTRACT_RO_NLP_VERSION', 'd16bba97890')
+        minio_client = get_minio()
+        object_name = document_id + "-" + EXTRACT_RO_NLP_VERSION + ".html"
 
         try:
-            html_file = minio_client.get_object(bucket_name, document_id + "-" + EXTRACT_RO_NLP_VERSION + ".html")
-            result = html_file.data
-
-            logger.info(result)
-            return Response(result, HTTP_200_OK)
+            html_stat = minio_client.stat_object(RO_HTML_BUCKET, object_name)
         except NoSuchKey as err:
             return Response("", HTTP_204_NO_CONTENT)
+
+        # the RO html of a document only changes when it is extracted again, which changes its etag
+        etag = quote_etag(html_stat.etag)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            response = HttpResponseNotModified()
+        else:
+            cache_key = 'ro_html:' + object_name + ':' + html_stat.etag
+            html = cache.get(cache_key)
+            if html is not None:
+                response = HttpResponse(html, content_type=RO_HTML_CONTENT_TYPE)
+            elif html_stat.size <= RO_HTML_CACHE_MAX_BYTES:
+                html_file = minio_client.get_object(RO_HTML_BUCKET, object_name)
+                try:
+                    html = html_file.data
+                finally:
+                    html_file.close()
+                    html_file.release_conn()
+                cache.set(cache_key, html, RO_HTML_CACHE_TIMEOUT)
+                response = HttpResponse(html, content_type=RO_HTML_CONTENT_TYPE)
+            else:
+                html_file = minio_client.get_object(RO_HTML_BUCKET, object_name)
+                response = StreamingHttpResponse(MinioObjectStream(html_file),
+                                                 content_type=RO_HTML_CONTENT_TYPE)
+                response['Content-Length'] = html_stat.size
+        response['ETag'] = etag
+        # browsers keep the html and revalidate it with If-None-Match
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class MinioObjectStream:
+    """
+    Streams a MinIO object in chunks. Django closes it with the response, so the connection is
+    released also when the response is never iterated, e.g. for a HEAD request or a client that went away.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        return self.response.stream(RO_HTML_STREAM_CHUNK_BYTES)
+
+    def close(self):
+        self.response.close()
+        self.response.release_conn()
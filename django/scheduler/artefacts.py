@@ -0,0 +1,64 @@
+import gzip
+import logging
+import os
+import tempfile
+
+from cassis import load_cas_from_xmi
+from cassis.xmi import CasXmiSerializer
+
+logger = logging.getLogger(__name__)
+
+# artefacts up to this size (compressed) stay in memory, larger ones are spooled to an anonymous temporary file
+ARTEFACT_SPOOL_MAX_BYTES = int(os.environ.get("ARTEFACT_SPOOL_MAX_BYTES", 32 * 1024 * 1024))
+
+
+def put_artefact(minio_client, bucket_name, object_name, write, content_type="application/octet-stream",
+                 compress=True):
+    """
+    Upload an artefact to MinIO without a named file in the working directory.
+    write(f) writes the artefact to the binary file object f, it is gzipped on the fly when compress is set.
+    MinIO needs the length up front, so the output is spooled first. Large artefacts are sent as a
+    multipart upload by the MinIO client.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=ARTEFACT_SPOOL_MAX_BYTES) as spool:
+        if compress:
+            with gzip.GzipFile(fileobj=spool, mode="wb") as f:
+                write(f)
+        else:
+            write(spool)
+        length = spool.tell()
+        spool.seek(0)
+        minio_client.put_object(bucket_name, object_name, spool, length, content_type)
+    logger.debug("Uploaded %s/%s (%s bytes)", bucket_name, object_name, length)
+    return length
+
+
+def put_cas(minio_client, bucket_name, object_name, cas):
+    """
+    Serialize a CAS to gzipped XMI straight into a MinIO upload.
+    """
+    return put_artefact(minio_client, bucket_name, object_name,
+                        lambda f: CasXmiSerializer().serialize(f, cas, pretty_print=False),
+                        "application/gzip")
+
+
+def put_text(minio_client, bucket_name, object_name, text, content_type):
+    """
+    Upload text as is, for artefacts that are served directly like the RO html.
+    """
+    return put_artefact(minio_client, bucket_name, object_name, lambda f: f.write(text.encode("utf-8")),
+                        content_type, compress=False)
+
+
+def get_cas(minio_client, bucket_name, object_name, typesystem):
+    """
+    Load a gzipped XMI CAS from MinIO, decompressing while it is downloaded.
+    Raises NoSuchKey when the object doesn't exist.
+    """
+    response = minio_client.get_object(bucket_name, object_name)
+    try:
+        with gzip.GzipFile(fileobj=response, mode="rb") as f:
+            return load_cas_from_xmi(f, typesystem=typesystem)
+    finally:
+        response.close()
+        response.release_conn()
@@ -0,0 +1,79 @@
+import gzip
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
+
+from searchapp.clients import get_minio
+
+logger = logging.getLogger(__name__)
+
+CAS_CACHE_BUCKET = 'cas-stage-cache'
+# set to false to always call every NLP service
+CAS_CACHE_ENABLED = os.environ.get('CAS_CACHE_ENABLED', 'true').lower() == 'true'
+
+_bucket_created = False
+
+
+def create_cas_cache_bucket(minio_client):
+    global _bucket_created
+    if _bucket_created:
+        return
+    try:
+        minio_client.make_bucket(CAS_CACHE_BUCKET)
+    except BucketAlreadyOwnedByYou:
+        pass
+    except BucketAlreadyExists:
+        pass
+    _bucket_created = True
+
+
+def source_key(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def stage_key(input_key, stage, version):
+    """
+    The output of a stage is keyed by the key of its input, the stage and the version of its service.
+    Keys are chained, so the key of a stage changes when any earlier stage or the source changes.
+    """
+    return hashlib.sha256((input_key + ':' + stage + ':' + version).encode('utf-8')).hexdigest()
+
+
+def cas_cache_object_name(stage, key):
+    return stage + '/' + key + '.gz'
+
+
+def get_cached_stage(stage, key):
+    """
+    Returns the cached output of a stage, or None. Failures are logged, the cache never fails a document.
+    """
+    if not CAS_CACHE_ENABLED:
+        return None
+    try:
+        cached = get_minio().get_object(CAS_CACHE_BUCKET, cas_cache_object_name(stage, key))
+    except NoSuchKey:
+        return None
+    except Exception as err:
+        logger.warning("Could not read %s output %s from the CAS cache: %r", stage, key, err)
+        return None
+    try:
+        return gzip.decompress(cached.data).decode('utf-8')
+    finally:
+        cached.close()
+        cached.release_conn()
+
+
+def store_cached_stage(stage, key, content):
+    if not CAS_CACHE_ENABLED:
+        return
+    try:
+        minio_client = get_minio()
+        create_cas_cache_bucket(minio_client)
+        content_gz = gzip.compress(content.encode('utf-8'))
+        minio_client.put_object(CAS_CACHE_BUCKET, cas_cache_object_name(stage, key), BytesIO(content_gz),
+                                len(content_gz), 'application/gzip')
+    except Exception as err:
+        logger.warning("Could not store %s output %s in the CAS cache: %r", stage, key, err)
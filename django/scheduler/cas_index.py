@@ -0,0 +1,64 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+
+class AnnotationIndex:
+    """
+    Sorted interval index over the annotations of one type in a CAS view.
+    Covering, covered and exact span lookups use binary search instead of scanning all annotations
+    of the type, as cassis select_covering does. The index is a snapshot: annotations added to the
+    view after it was built are not returned.
+    """
+
+    def __init__(self, annotations):
+        # same order as the cassis type index
+        self.annotations = sorted(annotations, key=lambda a: (a.begin, a.end))
+        self.begins = [a.begin for a in self.annotations]
+        # max_ends[i] is the largest end of annotations[0..i], to stop covering lookups early
+        self.max_ends = []
+        self.max_length = 0
+        self.spans = defaultdict(list)
+        max_end = None
+        for annotation in self.annotations:
+            max_end = annotation.end if max_end is None else max(max_end, annotation.end)
+            self.max_ends.append(max_end)
+            self.max_length = max(self.max_length, annotation.end - annotation.begin)
+            self.spans[(annotation.begin, annotation.end)].append(annotation)
+
+    @classmethod
+    def from_view(cls, view, type_name):
+        return cls(view.select(type_name))
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def covering(self, annotation):
+        """
+        Annotations with begin <= annotation.begin and end >= annotation.end.
+        """
+        begin, end = annotation.begin, annotation.end
+        # a covering annotation starts at or before begin, and no earlier than end - max_length
+        lo = bisect_left(self.begins, end - self.max_length)
+        i = bisect_right(self.begins, begin) - 1
+        result = []
+        while i >= lo and self.max_ends[i] >= end:
+            if self.annotations[i].end >= end:
+                result.append(self.annotations[i])
+            i -= 1
+        result.reverse()
+        return result
+
+    def covered(self, annotation):
+        """
+        Annotations with begin >= annotation.begin and end <= annotation.end.
+        """
+        begin, end = annotation.begin, annotation.end
+        lo = bisect_left(self.begins, begin)
+        hi = bisect_right(self.begins, end)
+        return [a for a in self.annotations[lo:hi] if a.end <= end]
+
+    def exact(self, annotation):
+        """
+        Annotations with the same begin and end as annotation.
+        """
+        return self.spans.get((annotation.begin, annotation.end), [])
@@ -0,0 +1,66 @@
+import re
+
+from cassis import Cas, load_cas_from_xmi
+from cassis.typesystem import FeatureStructure
+
+# a chunk may be cut after one of these closing tags, so paragraphs are never split
+BLOCK_END = re.compile(r"</(?:p|div|li|ul|ol|table|tr|h[1-6]|section|article|blockquote|pre)\s*>", re.IGNORECASE)
+# the chunk texts are joined with this separator in the merged CAS
+CHUNK_SEPARATOR = "\n"
+
+
+def split_html_paragraphs(content_html, max_chars):
+    """
+    Split html in chunks of at most max_chars on block element boundaries.
+    A single block larger than max_chars becomes a chunk of its own.
+    """
+    chunks = []
+    chunk_start = 0
+    last_end = 0
+    for match in BLOCK_END.finditer(content_html):
+        if match.end() - chunk_start > max_chars and last_end > chunk_start:
+            chunks.append(content_html[chunk_start:last_end])
+            chunk_start = last_end
+        last_end = match.end()
+    if len(content_html) - chunk_start > max_chars and chunk_start < last_end < len(content_html):
+        chunks.append(content_html[chunk_start:last_end])
+        chunk_start = last_end
+    chunks.append(content_html[chunk_start:])
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def merge_chunk_cases(chunk_xmis, typesystem, view_name, type_names):
+    """
+    Merge the CAS of every chunk in one CAS with a single view_name view.
+    The sofa strings are concatenated and the annotations of type_names are copied with their offsets
+    moved by the length of the text before their chunk. Features referring to other feature structures
+    are not copied.
+    """
+    texts = []
+    annotations = []
+    offset = 0
+    for xmi in chunk_xmis:
+        view = load_cas_from_xmi(xmi, typesystem=typesystem).get_view(view_name)
+        text = view.sofa_string or ""
+        for type_name in type_names:
+            for annotation in view.select(type_name):
+                annotations.append((annotation, offset))
+        texts.append(text)
+        offset += len(text) + len(CHUNK_SEPARATOR)
+
+    cas = Cas(typesystem=typesystem)
+    merged_view = cas.create_view(view_name)
+    merged_view.sofa_string = CHUNK_SEPARATOR.join(texts)
+    for annotation, offset in annotations:
+        annotation_type = typesystem.get_type(annotation.type)
+        features = {}
+        for feature in annotation_type.all_features:
+            if feature.name in ("sofa", "begin", "end"):
+                continue
+            value = getattr(annotation, feature.name)
+            if not isinstance(value, FeatureStructure):
+                features[feature.name] = value
+        merged_view.add_annotation(
+            annotation_type(begin=annotation.begin + offset, end=annotation.end + offset, **features), keep_id=False
+        )
+    return cas
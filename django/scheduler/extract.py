@@ -1,22 +1,39 @@
+import asyncio
 import time
 import base64
 import json
 import logging
 import os
-import urllib
-import pysolr
+import threading
+from contextlib import nullcontext
+from functools import partial
 import cassis
-import requests
 import math
-import gzip
 
 from cassis import Cas, load_cas_from_xmi, TypeSystem, merge_typesystems, load_dkpro_core_typesystem
 from cassis.typesystem import load_typesystem
 from celery import shared_task, chain
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils import timezone
 from glossary.models import Concept, ConceptOccurs, ConceptDefined
 from searchapp.models import Website, Document
-from obligations.models import ReportingObligation
-from minio import Minio, ResponseError
+from scheduler.artefacts import put_cas, put_text, get_cas
+from scheduler.cas_cache import get_cached_stage, store_cached_stage, source_key, stage_key
+from scheduler.cas_index import AnnotationIndex
+from scheduler.chunking import split_html_paragraphs, merge_chunk_cases
+from scheduler.nlp_pipeline import run_nlp_pipeline, NLP_DOCUMENTS_IN_FLIGHT
+from scheduler.pipeline import pipeline_stage, finish_fan_out_batch
+from scheduler.processing_state import skip_done, mark_done, mark_failed, mark_running, STAGE_EXTRACT_TERMS, \
+    STAGE_EXTRACT_RO
+from searchapp.solr_writer import SolrWriter
+from searchapp.clients import get_minio, get_http_session
+from searchapp.solr_call import solr_search_cursor, solr_get
+from obligations.build_rdf import ROGraph
+from obligations.cas_parser import CasContent, KEY_CHILDREN, KEY_VALUE
+from obligations.models import ReportingObligation, reporting_obligation_hash
+from obligations.rdf_call import build_ro_facet_snapshot
+from minio import ResponseError
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
 from pycaprio.mappings import InceptionFormat, DocumentState
 from pycaprio import Pycaprio
@@ -36,9 +53,24 @@ DEFINITIONS_EXTRACT_URL = os.environ["GLOSSARY_DEFINITIONS_EXTRACT_URL"]
 PARAGRAPH_DETECT_URL = os.environ["GLOSSARY_PARAGRAPH_DETECT_URL"]
 RO_EXTRACT_URL = os.environ["RO_EXTRACT_URL"]
 CAS_TO_RDF_API = os.environ["CAS_TO_RDF_API"]
-CELERY_EXTRACT_TERMS_CHUNKS = os.environ.get("CELERY_EXTRACT_TERMS_CHUNKS", 8)
+# documents per extract_terms_for_documents task, their NLP requests run concurrently
+EXTRACT_TERMS_BATCH_SIZE = int(os.environ.get("EXTRACT_TERMS_BATCH_SIZE", 32))
 EXTRACT_TERMS_NLP_VERSION = os.environ.get("EXTRACT_TERMS_NLP_VERSION", "8a4f1d58")
 EXTRACT_RO_NLP_VERSION = os.environ.get("EXTRACT_RO_NLP_VERSION", "d16bba97890")
+# documents per extract_reporting_obligations_for_documents task, their NLP requests run concurrently
+EXTRACT_RO_BATCH_SIZE = int(os.environ.get("EXTRACT_RO_BATCH_SIZE", 16))
+# reporting obligations looked up and inserted per query
+RO_UPSERT_BATCH_SIZE = 1000
+# postgres advisory lock held while the concepts of a document are saved
+CONCEPTS_LOCK_KEY = 4209130681
+# versions of the NLP services, the cached output of a stage is reused until its version changes
+HTML2TEXT_VERSION = os.environ.get("HTML2TEXT_VERSION", "1")
+PARAGRAPH_DETECT_VERSION = os.environ.get("PARAGRAPH_DETECT_VERSION", "1")
+DEFINITIONS_EXTRACT_VERSION = os.environ.get("DEFINITIONS_EXTRACT_VERSION", "1")
+TERM_EXTRACT_VERSION = os.environ.get("TERM_EXTRACT_VERSION", EXTRACT_TERMS_NLP_VERSION)
+# html documents larger than this are split on paragraphs in chunks of EXTRACT_TERMS_CHUNK_CHARS
+EXTRACT_TERMS_MAX_CHARS = int(os.environ.get("EXTRACT_TERMS_MAX_CHARS", 1000000))
+EXTRACT_TERMS_CHUNK_CHARS = int(os.environ.get("EXTRACT_TERMS_CHUNK_CHARS", 500000))
 
 SENTENCE_CLASS = "de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Sentence"
 TOKEN_CLASS = "cassis.Token"
@@ -49,7 +81,9 @@ VALUE_BETWEEN_TAG_TYPE_CLASS = "com.crosslang.uimahtmltotext.uima.type.ValueBetw
 DEPENDENCY_CLASS = "de.tudarmstadt.ukp.dkpro.core.api.syntax.type.dependency.Dependency"
 DEFINED_TYPE = "cassis.Token"
 
-DEFAULT_TYPESYSTEM = "/tmp/typesystem.xml"
+# bump when the UIMA html2text typesystem changes so workers fetch it again
+UIMA_TYPESYSTEM_VERSION = os.environ.get("UIMA_TYPESYSTEM_VERSION", "1")
+DEFAULT_TYPESYSTEM = "/tmp/typesystem-" + UIMA_TYPESYSTEM_VERSION + ".xml"
 TYPESYSTEM_USER = "scheduler/resources/typesystem_user.xml"
 
 sofa_id_html2text = "html2textView"
@@ -66,6 +100,17 @@ QUERY_ID_ASC = "id asc"
 QUERY_WEBSITE = "website:"
 
 RDF_FUSEKI_URL = os.environ["RDF_FUSEKI_URL"]
+# "api" sends the CAS of every document to CAS_TO_RDF_API, "local" builds the RO graph of a batch of documents
+# in process and uploads it to the Fuseki Graph Store in one request
+RO_RDF_MODE = os.environ.get("RO_RDF_MODE", "api")
+if RO_RDF_MODE not in ("api", "local"):
+    raise ImproperlyConfigured("RO_RDF_MODE must be 'api' or 'local', got %r" % RO_RDF_MODE)
+# Graph Store protocol endpoint of the RO dataset, e.g. http://fuseki:3030/ro/data
+RDF_FUSEKI_GRAPH_STORE_URL = os.environ.get("RDF_FUSEKI_GRAPH_STORE_URL", "")
+if RO_RDF_MODE == "local" and not RDF_FUSEKI_GRAPH_STORE_URL:
+    raise ImproperlyConfigured("RDF_FUSEKI_GRAPH_STORE_URL is required when RO_RDF_MODE is 'local'")
+# named graph the ROs are added to, the default graph when empty
+RO_RDF_GRAPH = os.environ.get("RO_RDF_GRAPH", "")
 
 
 def save_cas(cas, file_path):
@@ -80,24 +125,15 @@ def save_typesystem(typesystem, file_path):
         f.write(ts_xml.encode())
 
 
-def save_compressed_cas(cas, file_path):
-    cas_xmi = cas.to_xmi()
-    file = gzip.open(file_path, "wb")
-    file.write(cas_xmi.encode())
-    file.close()
-    return file
-
-
-def load_compressed_cas(file, typesystem):
-    with gzip.open(file, "rb") as f:
-        return load_cas_from_xmi(f, typesystem=typesystem)
+def get_nlp_session():
+    return get_http_session("nlp", pool_size=NLP_DOCUMENTS_IN_FLIGHT)
 
 
 def get_html2text_cas(content_html, docid):
     content_html_text = {"text": content_html}
     logger.info("Sending request to %s", UIMA_URL["BASE"] + UIMA_URL["HTML2TEXT"])
     start = time.time()
-    r = requests.post(UIMA_URL["BASE"] + UIMA_URL["HTML2TEXT"], json=content_html_text)
+    r = get_nlp_session().post(UIMA_URL["BASE"] + UIMA_URL["HTML2TEXT"], json=content_html_text)
 
     end = time.time()
     logger.info("UIMA Html2Text took %s seconds to succeed (code %s ) (id: %s ).", end - start, r.status_code, docid)
@@ -105,44 +141,118 @@ def get_html2text_cas(content_html, docid):
 
 
 def save_to_rdf(cas):
-    encoded_cas = base64.b64encode(bytes(cas.to_xmi(), "utf-8")).decode()
+    return save_xmi_to_rdf(cas.to_xmi())
+
+
+def save_xmi_to_rdf(cas_xmi):
+    encoded_cas = base64.b64encode(bytes(cas_xmi, "utf-8")).decode()
 
     json_content = {"content": encoded_cas}
 
-    logger.info("base64 cas (ROs): %s", encoded_cas)
+    logger.debug("base64 cas (ROs): %s", encoded_cas)
 
     start = time.time()
-    r = requests.post(CAS_TO_RDF_API, json=json_content)
+    r = get_nlp_session().post(CAS_TO_RDF_API, json=json_content)
     end = time.time()
     logger.info("Sent request to %s. Status code: %s Took %s seconds", CAS_TO_RDF_API, r.status_code, end - start)
     return r
 
 
-def create_cas(sofa):
-    with open(DEFAULT_TYPESYSTEM, "rb") as f:
-        ts = load_typesystem(f)
+def upload_ro_graph(graph):
+    """
+    Add the triples of graph to Fuseki as N-Triples with one Graph Store protocol request.
+    """
+    if RO_RDF_GRAPH:
+        url = RDF_FUSEKI_GRAPH_STORE_URL
+        params = {"graph": RO_RDF_GRAPH}
+    else:
+        url = RDF_FUSEKI_GRAPH_STORE_URL + "?default"
+        params = None
+    data = graph.serialize(format="nt")
+    start = time.time()
+    r = get_http_session("fuseki").post(
+        url, params=params, data=data, headers={"Content-Type": "application/n-triples; charset=utf-8"}
+    )
+    r.raise_for_status()
+    end = time.time()
+    logger.info("Uploaded %s triples to %s. Took %s seconds", len(graph), RDF_FUSEKI_GRAPH_STORE_URL, end - start)
+    return r
+
 
-    cas = Cas(typesystem=ts)
+def create_cas(sofa):
+    cas = Cas(typesystem=fetch_typesystem())
     cas.sofa_string = sofa
     return cas
 
 
-def fetch_typesystem():
-    try:
-        # Check if file exits
-        f = open(DEFAULT_TYPESYSTEM)
-        f.close()
-    except IOError:
-        # Fetch from UIMA
-        typesystem_req = requests.get(UIMA_URL["BASE"] + UIMA_URL["TYPESYSTEM"])
-        typesystem_file = open(DEFAULT_TYPESYSTEM, "w")
-        typesystem_file.write(typesystem_req.content.decode("utf-8"))
-
-    # FIXME: load only once ?
+# Parsed typesystems are cached per process, keyed by name, typesystem and NLP version.
+# Typesystems are not modified after they have been loaded, so they are shared by all CASes.
+_typesystem_cache = {}
+_typesystem_cache_lock = threading.RLock()
+
+
+def get_cached_typesystem(name, loader):
+    key = (name, UIMA_TYPESYSTEM_VERSION, EXTRACT_TERMS_NLP_VERSION)
+    with _typesystem_cache_lock:
+        typesystem = _typesystem_cache.get(key)
+        if typesystem is None:
+            typesystem = _typesystem_cache[key] = loader()
+        return typesystem
+
+
+def invalidate_typesystem_cache():
+    """
+    Forget all cached typesystems, the UIMA typesystem is fetched again on next use.
+    """
+    with _typesystem_cache_lock:
+        _typesystem_cache.clear()
+        if os.path.exists(DEFAULT_TYPESYSTEM):
+            os.remove(DEFAULT_TYPESYSTEM)
+
+
+def load_uima_typesystem():
+    if not os.path.exists(DEFAULT_TYPESYSTEM):
+        # Fetch from UIMA, write to a temporary file first so other workers never read a partial file
+        typesystem_req = get_nlp_session().get(UIMA_URL["BASE"] + UIMA_URL["TYPESYSTEM"])
+        typesystem_req.raise_for_status()
+        tmp_file = DEFAULT_TYPESYSTEM + "." + str(os.getpid())
+        with open(tmp_file, "wb") as f:
+            f.write(typesystem_req.content)
+        os.replace(tmp_file, DEFAULT_TYPESYSTEM)
+
     with open(DEFAULT_TYPESYSTEM, "rb") as f:
         return load_typesystem(f)
 
 
+def load_user_typesystem():
+    with open(TYPESYSTEM_USER, "rb") as f:
+        return load_typesystem(f)
+
+
+def fetch_typesystem():
+    return get_cached_typesystem("uima", load_uima_typesystem)
+
+
+def get_fisma_typesystem():
+    return get_cached_typesystem("fisma", generate_typesystem_fisma)
+
+
+def get_merged_typesystem():
+    """
+    UIMA typesystem merged with the FISMA term and definition types.
+    """
+    return get_cached_typesystem("merged", lambda: merge_typesystems(get_fisma_typesystem(), fetch_typesystem()))
+
+
+def get_user_typesystem():
+    return get_cached_typesystem("user", load_user_typesystem)
+
+
+def get_merged_user_typesystem():
+    return get_cached_typesystem("user_merged", lambda: merge_typesystems(get_user_typesystem(),
+                                                                          get_fisma_typesystem()))
+
+
 def get_cas_from_pdf(content, docid):
     # Logic for documents without HTML, that have a "content" field which is a PDF to HTML done by Tika
     # Create a new cas here
@@ -159,7 +269,7 @@ def get_cas_from_pdf(content, docid):
 
     logger.info("Sending request to Paragraph Detection (PDF) (%s)", PARAGRAPH_DETECT_URL)
     logger.info("input_for_paragraph_detection: %s", input_for_paragraph_detection)
-    r = requests.post(PARAGRAPH_DETECT_URL, json=input_for_paragraph_detection)
+    r = get_nlp_session().post(PARAGRAPH_DETECT_URL, json=input_for_paragraph_detection)
     end = time.time()
     logger.info("Paragraph Detect took %s seconds to succeed (code: %s) (id: %s).", end - start, r.status_code, docid)
     logger.info("Output: %s", r.content)
@@ -174,7 +284,7 @@ def get_cas_from_paragraph_detection(content_encoded, docid):
 
     logger.info("Sending request to Paragraph Detection (HTML) (%s)", PARAGRAPH_DETECT_URL)
     start = time.time()
-    paragraph_request = requests.post(PARAGRAPH_DETECT_URL, json=input_for_paragraph_detection)
+    paragraph_request = get_nlp_session().post(PARAGRAPH_DETECT_URL, json=input_for_paragraph_detection)
     end = time.time()
     logger.info(
         "Paragraph Detect took %s seconds to succeed (code: %s) (id: %s).",
@@ -192,7 +302,7 @@ def get_reporting_obligations(input_cas_encoded):
     }
 
     start = time.time()
-    ro_request = requests.post(RO_EXTRACT_URL, json=input_for_reporting_obligations)
+    ro_request = get_nlp_session().post(RO_EXTRACT_URL, json=input_for_reporting_obligations)
     end = time.time()
     logger.info("Sent request to RO Extraction. Status code: %s Took % seconds", ro_request.status_code, end - start)
 
@@ -213,7 +323,7 @@ def get_cas_from_definitions_extract(input_cas_encoded, docid):
 
     logger.info("Sending request to DefinitionExtract NLP (%s)", DEFINITIONS_EXTRACT_URL)
     start = time.time()
-    definitions_request = requests.post(DEFINITIONS_EXTRACT_URL, json=input_for_term_defined)
+    definitions_request = get_nlp_session().post(DEFINITIONS_EXTRACT_URL, json=input_for_term_defined)
     end = time.time()
     logger.info(
         "DefinitionExtract took %s seconds to succeed (code: %s) (id: %s).",
@@ -229,7 +339,7 @@ def get_cas_from_text_extract(input_cas_encoded, docid):
     text_cas = {"cas_content": input_cas_encoded, "content_type": "html", "extract_supergrams": "false"}
     logger.info("Sending request to TextExtract NLP (%s)", TERM_EXTRACT_URL)
     start = time.time()
-    request_nlp = requests.post(TERM_EXTRACT_URL, json=text_cas)
+    request_nlp = get_nlp_session().post(TERM_EXTRACT_URL, json=text_cas)
     end = time.time()
     logger.info(
         "TermExtract took %s seconds to succeed (code: %s) (id: %s).", end - start, request_nlp.status_code, docid
@@ -237,177 +347,249 @@ def get_cas_from_text_extract(input_cas_encoded, docid):
     return request_nlp
 
 
-def post_pre_analyzed_to_solr(data):
-    params = json.dumps(data).encode("utf8")
-    # FIXME: find a way to commit when all the work is done, commits after 15s now
-    req = urllib.request.Request(
-        os.environ["SOLR_URL"] + "/documents/update?commitWithin=15000",
-        data=params,
-        headers={"content-type": "application/json"},
-    )
-    response = urllib.request.urlopen(req)
-    logger.info(response.read().decode("utf8"))
+def post_pre_analyzed_to_solr(data, writer=None):
+    # updates for the same document are merged by the writer, they become visible within SOLR_COMMIT_WITHIN
+    if writer is not None:
+        writer.add(data)
+        return
+    with SolrWriter("documents") as writer:
+        writer.add(data)
 
 
 @shared_task
-def extract_reporting_obligations(website_id):
+def extract_reporting_obligations(website_id, run_id=None):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     core = "documents"
-    page_number = 0
     rows_per_page = 250
-    cursor_mark = "*"
 
     q = QUERY_WEBSITE + website_name
     # q = QUERY_WEBSITE + website_name + " AND acceptance_state:accepted"
 
-    # Load all documents from Solr
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {
-        "rows": rows_per_page,
-        "start": page_number,
-        "cursorMark": cursor_mark,
-        "sort": QUERY_ID_ASC,
-        "fl": "content_html,content,id",
-    }
-    documents = client.search(q, **options)
+    with pipeline_stage(website_id, "extract_reporting_obligations", run_id, fan_out=True) as run:
+        # Load the ids of all documents from Solr, one page at a time, documents done with this version are skipped
+        documents = skip_done(
+            solr_search_cursor(core, q, fl="id", rows=rows_per_page),
+            STAGE_EXTRACT_RO,
+            EXTRACT_RO_NLP_VERSION,
+        )
+        batches = []
+        batch = []
+        for doc in documents:
+            run.documents_in += 1
+            batch.append(doc["id"])
+            if len(batch) == EXTRACT_RO_BATCH_SIZE:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+
+    # Sent once the run is saved, the batch tasks add their counts to it and the last one finishes it
+    for batch in batches:
+        extract_reporting_obligations_for_documents.delay(batch, website_id, run.pk)
 
-    # Load typesystem
-    ts = fetch_typesystem()
 
-    for document in documents:
-        logger.info("Started RO extraction for document id: %s", document["id"])
+@shared_task
+def extract_reporting_obligations_for_documents(document_ids, website_id=None, run_pk=None):
+    """
+    Extract reporting obligations for a batch of documents, keeping the NLP requests of several documents in flight.
+    """
+    documents = [{"id": str(document_id)} for document_id in document_ids]
+    document_ids = [document["id"] for document in documents]
+    mark_running(website_id, document_ids, STAGE_EXTRACT_RO, EXTRACT_RO_NLP_VERSION)
+    # in local mode the RO graph of the batch is built by the post-processing and uploaded at the end
+    graph = ROGraph() if RO_RDF_MODE == "local" else None
+    graph_obligations = {}
+    processed, skipped, failures = run_nlp_pipeline(
+        documents,
+        fetch_reporting_obligations,
+        partial(process_reporting_obligations, graph=graph, graph_obligations=graph_obligations),
+    )
+    failed = {document["id"]: err for document, err in failures}
+    if graph_obligations:
+        try:
+            upload_ro_graph(graph)
+            # the ids minted for the graph are only stored once it is uploaded
+            save_reporting_obligations(
+                [obligation for obligations in graph_obligations.values() for obligation in obligations]
+            )
+        except Exception as err:
+            logger.exception("Failed to upload the RO graph of %s documents", len(graph_obligations))
+            processed -= len(graph_obligations)
+            for document_id in graph_obligations:
+                failed[document_id] = err
+    for document_id, err in failed.items():
+        mark_failed(website_id, [document_id], STAGE_EXTRACT_RO, EXTRACT_RO_NLP_VERSION, err)
+    mark_done(
+        website_id,
+        [document_id for document_id in document_ids if document_id not in failed],
+        STAGE_EXTRACT_RO,
+        EXTRACT_RO_NLP_VERSION,
+    )
+    if run_pk is not None:
+        aggregate_reporting_obligations(run_pk, processed + skipped, len(failed), len(document_ids))
+    return {"processed": processed, "skipped": skipped, "failed": list(failed)}
 
-        is_html = False
-        is_pdf = False
-        r = None
-        paragraph_request = None
 
-        # Check if document is a html or pdf document
-        if "content_html" in document:
-            logger.info(
-                "Extracting terms from HTML document id: %s (%s chars)",
-                document["id"],
-                len(document["content_html"][0]),
-            )
-            is_html = True
+def aggregate_reporting_obligations(run_pk, documents_out, errors, batch_size):
+    """
+    Add the counts of a batch to the PipelineRun, the batch completing the run refreshes the RO facet snapshot.
+    """
+    if finish_fan_out_batch(run_pk, documents_out, errors, batch_size):
+        try:
+            build_ro_facet_snapshot()
+        except Exception:
+            # the previous snapshot is served until the next ingest
+            logger.exception("Failed to build the RO facet snapshot")
+
+
+async def fetch_reporting_obligations(call, document):
+    """
+    NLP part of the RO extraction: html2text, paragraph detection, RO extraction, html2text of the RO html
+    and the CAS-to-RDF conversion, unless the RDF is built locally.
+    Returns the RO html, the html2text XMI of the RO html and the CAS-to-RDF response or None, or None when
+    the document is skipped.
+    """
+    logger.info("Started RO extraction for document id: %s", document["id"])
+    document = await call.io(get_document_content, document["id"])
+
+    # Check if document is a html or pdf document
+    if "content_html" in document:
+        logger.info(
+            "Extracting ROs from HTML document id: %s (%s chars)", document["id"], len(document["content_html"][0])
+        )
+        r = await call("html2text", get_html2text_cas, document["content_html"][0], document["id"])
+        # Paragraph Detection for HTML
+        paragraph_request = await call(
+            "paragraphs", get_cas_from_paragraph_detection, get_encoded_content_from_cas(r), document["id"]
+        )
+    elif "content" in document:
+        logger.info("Extracting ROs from PDF document id: %s (%s chars)", document["id"], len(document["content"][0]))
+        # Paragraph detection for PDF + fallback cas for not having a html2text request
+        paragraph_request = await call("paragraphs", get_cas_from_pdf, document["content"][0], document["id"])
+    else:
+        logger.info("No content to extract ROs from for document id: %s", document["id"])
+        return None
 
-        elif "content_html" not in document and "content" in document:
-            logger.info(
-                "Extracting terms from PDF document id: %s (%s chars)", document["id"], len(document["content"][0])
-            )
-            is_pdf = True
+    cas_content = json.loads(paragraph_request.content).get("cas_content")
+    if not cas_content:
+        raise ValueError("Paragraph detection returned no CAS (code %s)" % paragraph_request.status_code)
 
-            # TODO Remove this later when pdf works
-            # logger.warning("PDF CURRENTLY NOT SUPPORTED, SKIPPED.")
-            # continue
+    # Send to RO API
+    ro_request = await call("ro", get_reporting_obligations, cas_content)
+    if ro_request.status_code != 200:
+        raise ValueError("RO extraction returned HTTP %s" % ro_request.status_code)
 
-        if is_html:
-            r = get_html2text_cas(document["content_html"][0])
+    # Create new cas with sofa from RO API
+    ro_cas = base64.b64decode(get_cas_content(ro_request)).decode("utf-8")
+    sofa_reporting_obligations = await call.io(get_reporting_obligations_sofa, ro_cas)
 
-        # Paragraph detection for PDF + fallback cas for not having a html2text request
-        if is_pdf:
-            logger.info("get_cas_from_pdf")
-            r = get_cas_from_pdf(document["content"][0], document["id"])
-            paragraph_request = r
+    # Now send the RO html to UIMA Html2Text for the VBTT annotations
+    r = await call("html2text", get_html2text_cas, sofa_reporting_obligations, document["id"])
+    html2text_xmi = r.content.decode("utf-8")
 
-        logger.info("")
-        encoded_b64 = get_encoded_content_from_cas(r)
+    if RO_RDF_MODE == "local":
+        return sofa_reporting_obligations, html2text_xmi, None
+    # Send CAS to Laurens API
+    rdf_request = await call("cas_to_rdf", save_xmi_to_rdf, html2text_xmi)
+    return sofa_reporting_obligations, html2text_xmi, rdf_request
 
-        # Paragraph Detection for HTML
-        if is_html:
-            paragraph_request = get_cas_from_paragraph_detection(encoded_b64)
 
-        if not paragraph_request.content["cas_content"]:
-            logger.error("Something went wrong in paragraph detection.")
-            continue
+def get_reporting_obligations_sofa(ro_cas):
+    cas = load_cas_from_xmi(ro_cas, typesystem=fetch_typesystem())
+    return cas.get_view("ReportingObligationsView").sofa_string
 
-        # Send to RO API
-        res = json.loads(paragraph_request.content.decode("utf-8"))
-        ro_request = get_reporting_obligations(res["cas_content"])
-
-        # Create new cas with sofa from RO API
-        if ro_request.status_code == 200:
-            ro_cas = base64.b64decode(json.loads(ro_request.content)["cas_content"]).decode("utf-8")
-            # logger.info("ro_cas: %s", ro_cas)
-
-            cas = load_cas_from_xmi(ro_cas, typesystem=ts)
-            sofa_reporting_obligations = cas.get_view("ReportingObligationsView").sofa_string
-
-            logger.info("sofa_reporting_obligations: %s", sofa_reporting_obligations)
-            # Save the HTML view of the reporting obligations
-            # Save CAS to MINIO
-            minio_client = Minio(
-                os.environ["MINIO_STORAGE_ENDPOINT"],
-                access_key=os.environ["MINIO_ACCESS_KEY"],
-                secret_key=os.environ["MINIO_SECRET_KEY"],
-                secure=False,
-            )
-            bucket_name = "ro-html-output"
-            try:
-                minio_client.make_bucket(bucket_name)
-            except BucketAlreadyOwnedByYou as err:
-                pass
-            except BucketAlreadyExists as err:
-                pass
-
-            logger.info("Created bucket: %s", bucket_name)
-            filename = document["id"] + "-" + EXTRACT_RO_NLP_VERSION + ".html"
-
-            html_file = open(filename, "w")
-            html_file.write(sofa_reporting_obligations)
-            html_file.close()
-
-            minio_client.fput_object(bucket_name, html_file.name, filename, "text/html; charset=UTF-8")
-            logger.info("Uploaded to minio")
-
-            os.remove(html_file.name)
-            logger.info("Removed file from system")
-
-            # Now send the CAS to UIMA Html2Text for the VBTT annotations (paragraph_request)
-            r = get_html2text_cas(sofa_reporting_obligations, document["id"])
-            cas_html2text = load_cas_from_xmi(r.content.decode("utf-8"), typesystem=ts)
-
-            # This is the CAS with reporting obligations wrapped in VBTT's
-            # logger.info("cas_html2text: %s", cas_html2text.to_xmi())
-
-            # Save RO's to Django
-            for vbtt in cas_html2text.get_view(sofa_id_html2text).select(VALUE_BETWEEN_TAG_TYPE_CLASS):
-                if vbtt.tagName == "p":
-                    # Save to Django
-                    ReportingObligation.objects.update_or_create(
-                        name=vbtt.get_covered_text(), definition=vbtt.get_covered_text()
-                    )
-                    logger.info("[CAS] Saved Reporting Obligation to Django: %s", vbtt.get_covered_text())
 
-            # Send CAS to Laurens API
+def process_reporting_obligations(document, result, graph=None, graph_obligations=None):
+    """
+    Store the RO html in MinIO and the reporting obligations in Django.
+    When graph is given the ROs are added to it, and all obligations of the document, with their graph ids,
+    are put in graph_obligations by document id to be saved once the graph is uploaded.
+    """
+    sofa_reporting_obligations, html2text_xmi, rdf_request = result
 
-            r = save_to_rdf(cas_html2text)
-            if r.status_code == 200:
-                rdf_json = r.json()
+    # Save the HTML view of the reporting obligations
+    minio_client = get_minio()
+    bucket_name = "ro-html-output"
+    try:
+        minio_client.make_bucket(bucket_name)
+    except BucketAlreadyOwnedByYou as err:
+        pass
+    except BucketAlreadyExists as err:
+        pass
 
-                logger.info("rdf_json: %s", rdf_json)
+    filename = document["id"] + "-" + EXTRACT_RO_NLP_VERSION + ".html"
+    put_text(minio_client, bucket_name, filename, sofa_reporting_obligations, "text/html; charset=UTF-8")
+    logger.info("Uploaded RO html to minio: %s", filename)
+
+    # This is the CAS with reporting obligations wrapped in VBTT's
+    cas_html2text = load_cas_from_xmi(html2text_xmi, typesystem=fetch_typesystem())
+
+    # Save RO's to Django
+    obligations = []
+    for vbtt in cas_html2text.get_view(sofa_id_html2text).select(VALUE_BETWEEN_TAG_TYPE_CLASS):
+        if vbtt.tagName == "p":
+            obligations.append((vbtt.get_covered_text(), vbtt.get_covered_text(), None))
+
+    if rdf_request is not None and rdf_request.status_code == 200:
+        for item in rdf_request.json()["children"]:
+            obligations.append((item["value"], item["value"], item["id"]))
+    elif rdf_request is not None:
+        logger.info("[RDF]: Failed to save CAS to RDF. Response code: %s", rdf_request.status_code)
+
+    if graph is None:
+        save_reporting_obligations(obligations)
+        logger.info("Saved %s reporting obligations to Django for document id: %s", len(obligations), document["id"])
+        return
+
+    # nothing of the document is saved before the graph of the batch is uploaded
+    cas_content = CasContent.from_cassis_cas(cas_html2text)
+    graph.add_cas_content(cas_content)
+    graph_obligations[document["id"]] = obligations + [
+        (ro[KEY_VALUE], ro[KEY_VALUE], ro["id"]) for ro in cas_content[KEY_CHILDREN]
+    ]
 
-                for item in rdf_json["children"]:
-                    rdf_value = item["value"]
-                    rdf_id = item["id"]
 
-                    ReportingObligation.objects.update_or_create(
-                        name=rdf_value, definition=rdf_value, defaults={"rdf_id": rdf_id}
-                    )
-                    logger.info("[RDF] Saved Reporting Obligation to Django: %s", rdf_value)
-            else:
-                logger.info("[RDF]: Failed to save CAS to RDF. Response code: %s", r.status_code)
+def save_reporting_obligations(obligations):
+    """
+    Insert or update reporting obligations with bulk queries, rows are found by their content hash.
+    obligations holds (name, definition, rdf_id), an rdf_id of None keeps the rdf_id of an existing row.
+    """
+    rows = {}
+    for name, definition, rdf_id in obligations:
+        row = rows.setdefault(reporting_obligation_hash(name, definition), [name, definition, None])
+        if rdf_id is not None:
+            row[2] = rdf_id
+
+    content_hashes = list(rows)
+    for i in range(0, len(content_hashes), RO_UPSERT_BATCH_SIZE):
+        batch = content_hashes[i : i + RO_UPSERT_BATCH_SIZE]
+        existing = {ro.content_hash: ro for ro in ReportingObligation.objects.filter(content_hash__in=batch)}
+        now = timezone.now()
+        to_update = []
+        for content_hash, ro in existing.items():
+            if rows[content_hash][2] is not None:
+                ro.rdf_id = rows[content_hash][2]
+            ro.updated_at = now
+            to_update.append(ro)
+        ReportingObligation.objects.bulk_update(to_update, ["rdf_id", "updated_at"])
+        # rows inserted concurrently by another batch are skipped by the unique index
+        new_obligations = []
+        for content_hash in batch:
+            if content_hash not in existing:
+                name, definition, rdf_id = rows[content_hash]
+                new_obligations.append(
+                    ReportingObligation(name=name, definition=definition, rdf_id=rdf_id, content_hash=content_hash)
+                )
+        ReportingObligation.objects.bulk_create(new_obligations, ignore_conflicts=True)
 
 
 @shared_task
-def extract_terms(website_id, document_id=None):
+def extract_terms(website_id, document_id=None, run_id=None):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     core = "documents"
-    page_number = 0
     rows_per_page = 250
-    cursor_mark = "*"
 
     if document_id:
         q = "id:" + document_id
@@ -417,75 +599,220 @@ def extract_terms(website_id, document_id=None):
         # select all accepted documents with empty concept_occurs field
         q = QUERY_WEBSITE + website_name + ' AND acceptance_state:accepted AND -concept_occurs: ["" TO *]'
 
-    # Load all documents from Solr
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {
-        "rows": rows_per_page,
-        "start": page_number,
-        "cursorMark": cursor_mark,
-        "sort": QUERY_ID_ASC,
-        "fl": "content_html,content,id",
-    }
-    documents = client.search(q, **options)
+    with pipeline_stage(website_id, "extract_terms", run_id, fan_out=True) as run:
+        # Load the ids of all documents from Solr, one page at a time
+        documents = solr_search_cursor(core, q, fl="id", rows=rows_per_page)
+        if not document_id:
+            # resume after interruptions, documents done with this version are skipped
+            documents = skip_done(documents, STAGE_EXTRACT_TERMS, EXTRACT_TERMS_NLP_VERSION)
+
+        # Divide the documents in batches, the extraction itself runs in the batch tasks.
+        # Only ids are sent to the broker, the tasks read the content from Solr
+        batches = []
+        batch = []
+        for doc in documents:
+            run.documents_in += 1
+            batch.append(doc["id"])
+            if len(batch) == EXTRACT_TERMS_BATCH_SIZE:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+
+    # Sent once the run is saved, the batch tasks add their counts to it and the last one finishes it
+    for batch in batches:
+        extract_terms_for_documents.delay(batch, website_id, run.pk)
 
-    # Divide the document in chunks
-    extract_terms_for_document.chunks(zip(documents), int(CELERY_EXTRACT_TERMS_CHUNKS)).delay()
+
+@shared_task
+def extract_terms_for_documents(documents, website_id=None, run_pk=None):
+    """
+    Extract terms for a batch of documents, keeping the NLP requests of several documents in flight.
+    documents is a list of ids, Solr documents with their content are still accepted.
+    """
+    documents = [as_term_document(document) for document in documents]
+    document_ids = [document["id"] for document in documents]
+    mark_running(website_id, document_ids, STAGE_EXTRACT_TERMS, EXTRACT_TERMS_NLP_VERSION)
+    processed, skipped, failed = run_term_extraction(documents)
+    for document_id, err in failed.items():
+        mark_failed(website_id, [document_id], STAGE_EXTRACT_TERMS, EXTRACT_TERMS_NLP_VERSION, err)
+    mark_done(
+        website_id,
+        [document_id for document_id in document_ids if document_id not in failed],
+        STAGE_EXTRACT_TERMS,
+        EXTRACT_TERMS_NLP_VERSION,
+    )
+    if run_pk is not None:
+        finish_fan_out_batch(run_pk, processed + skipped, len(failed), len(document_ids))
+    return {"processed": processed, "skipped": skipped, "failed": list(failed)}
 
 
 @shared_task
 def extract_terms_for_document(document):
-
+    processed, skipped, failed = run_term_extraction([as_term_document(document)])
+    if failed:
+        raise next(iter(failed.values()))
+
+
+def run_term_extraction(documents):
+    """
+    Run the term extraction pipeline for the documents. The PreAnalyzed Solr updates of all documents
+    are buffered in one writer and sent in size bounded batches.
+    Returns the number of processed and skipped documents and the errors by document id,
+    a document is counted in only one of them.
+    """
+    failed = {}
+    processed_ids = []
+    writer = SolrWriter("documents", on_error=lambda doc_id, err: failed.setdefault(doc_id, err))
+
+    def process(document, terms_decoded_cas):
+        process_terms_cas(document, terms_decoded_cas, writer=writer)
+        processed_ids.append(document["id"])
+
+    processed, skipped, failures = run_nlp_pipeline(documents, fetch_terms_cas, process)
+    for document, err in failures:
+        failed[document["id"]] = err
+    try:
+        writer.close()
+    except Exception as err:
+        # the buffered updates are lost, don't mark their documents as done
+        logger.exception("Failed to send the concept fields to Solr")
+        for document_id in processed_ids:
+            failed.setdefault(document_id, err)
+    # documents whose Solr update failed were counted as processed by the pipeline
+    processed -= len(set(processed_ids) & set(failed))
+    return processed, skipped, failed
+
+
+def as_term_document(document):
+    # a document id, or a Solr document with content from before tasks were sent ids only
+    if isinstance(document, dict):
+        return document
+    return {"id": str(document)}
+
+
+def get_document_content(document_id):
+    """
+    Read the content the NLP pipelines need from Solr.
+    """
+    return solr_get("documents", document_id, fl="content_html,content,id") or {"id": document_id}
+
+
+def get_cas_content(r):
+    return json.loads(r.content)["cas_content"]
+
+
+async def fetch_terms_cas(call, document):
+    """
+    NLP part of the term extraction: html2text, paragraph detection, definition and term extraction.
+    The base64 CAS returned by every stage is cached in MinIO, keyed by its input and the service version,
+    so a rerun starts at the first stage whose version changed.
+    Large html documents are split on paragraphs and their chunks go through the services concurrently.
+    Returns the XMI from the term extraction, a list of XMIs for a chunked document, or None when the
+    document is skipped.
+    """
     logger.info("Started term extraction for document id: %s", document["id"])
+    if "content_html" not in document and "content" not in document:
+        # only the id was sent, read the content in a thread so other documents keep going
+        document = await call.io(get_document_content, document["id"])
 
-    # Load fisma specific types
-    ts_fisma = generate_typesystem_fisma()
-    term_type = ts_fisma.get_type("com.crosslang.fisma.Term")
-    definition_type = ts_fisma.get_type("com.crosslang.fisma.Definition")
-    defiterm_type = ts_fisma.get_type("com.crosslang.fisma.DefinitionTerm")
-
-    # Generate and write tempfile for typesystem.xml
-    typesystem = merge_typesystems(ts_fisma, fetch_typesystem())
-
-    django_doc = Document.objects.get(id=document["id"])
-    r = None
-    paragraph_request = None
-
+    # (service, version, request function, function returning the base64 CAS from the response)
     if "content_html" in document:
-        if document["content_html"] is not None:
-            if len(document["content_html"][0]) > 1000000:
-                logger.info("Skipping too big document id: %s", document["id"])
-                return
-
         logger.info(
             "Extracting terms from HTML document id: %s (%s chars)", document["id"], len(document["content_html"][0])
         )
-        # Html2Text - Get XMI from UIMA - Only when HTML not for PDFs
-        r = get_html2text_cas(document["content_html"][0], django_doc.id)
-        encoded_b64 = get_encoded_content_from_cas(r)
-        # Paragraph Detection for HTML
-        paragraph_request = get_cas_from_paragraph_detection(encoded_b64, django_doc.id)
-
+        source = document["content_html"][0]
+        stages = [
+            # Html2Text - Get XMI from UIMA - Only when HTML not for PDFs
+            ("html2text", HTML2TEXT_VERSION, get_html2text_cas, get_encoded_content_from_cas),
+            # Paragraph Detection for HTML
+            ("paragraphs", PARAGRAPH_DETECT_VERSION, get_cas_from_paragraph_detection, get_cas_content),
+        ]
     elif "content_html" not in document and "content" in document:
         logger.info(
             "Extracting terms from PDF document id: %s (%s chars)", document["id"], len(document["content"][0])
         )
-        # Paragraph detection for PDF + fallback cas for not having a html2text request
-        r = get_cas_from_pdf(document["content"][0], django_doc.id)
-        paragraph_request = r
-
-    # Term definition
-    input_content = json.loads(paragraph_request.content)["cas_content"]
-    definitions_request = get_cas_from_definitions_extract(input_content, django_doc.id)
+        source = document["content"][0]
+        stages = [
+            # Paragraph detection for PDF + fallback cas for not having a html2text request
+            ("paragraphs_pdf", PARAGRAPH_DETECT_VERSION + ":" + UIMA_TYPESYSTEM_VERSION, get_cas_from_pdf,
+             get_cas_content),
+        ]
+    else:
+        logger.info("No content to extract terms from for document id: %s", document["id"])
+        return None
+    stages += [
+        # Term definition
+        ("definitions", DEFINITIONS_EXTRACT_VERSION, get_cas_from_definitions_extract, get_cas_content),
+        # Step 3: NLP TextExtract
+        ("terms", TERM_EXTRACT_VERSION, get_cas_from_text_extract, get_cas_content),
+    ]
 
-    # Step 3: NLP TextExtract
-    input_content = json.loads(definitions_request.content)["cas_content"]
-    request_nlp = get_cas_from_text_extract(input_content, django_doc.id)
+    if "content_html" in document and len(source) > EXTRACT_TERMS_MAX_CHARS:
+        chunks = split_html_paragraphs(source, EXTRACT_TERMS_CHUNK_CHARS)
+        logger.info("Extracting terms from document id: %s in %d chunks", document["id"], len(chunks))
+        return list(await asyncio.gather(*(run_nlp_stages(call, document["id"], chunk, stages) for chunk in chunks)))
+    return await run_nlp_stages(call, document["id"], source, stages)
+
+
+async def run_nlp_stages(call, doc_id, source, stages):
+    """
+    Send source through the NLP stages, starting after the last stage with a cached output.
+    Returns the decoded XMI of the last stage.
+    """
+    keys = []
+    key = source_key(source)
+    for service, version, _, _ in stages:
+        key = stage_key(key, service, version)
+        keys.append(key)
+
+    # Start after the last stage with a cached output
+    content = source
+    start = 0
+    for i in reversed(range(len(stages))):
+        cached = await call.io(get_cached_stage, stages[i][0], keys[i])
+        if cached is not None:
+            logger.info("Reusing cached %s output for document id: %s", stages[i][0], doc_id)
+            content = cached
+            start = i + 1
+            break
+
+    for (service, version, request, cas_content), key in zip(stages[start:], keys[start:]):
+        r = await call(service, request, content, doc_id)
+        content = cas_content(r)
+        await call.io(store_cached_stage, service, key, content)
 
     # Decoded cas from termextract
-    terms_decoded_cas = base64.b64decode(json.loads(request_nlp.content)["cas_content"]).decode("utf-8")
+    return base64.b64decode(content).decode("utf-8")
+
+
+def process_terms_cas(document, terms_decoded_cas, writer=None):
+    """
+    CPU and database part of the term extraction: find definitions and terms in the CAS from the NLP
+    services, store them in Django and Solr and archive the CAS in MinIO.
+    The Solr updates are buffered in writer when it is given, so they are sent with other documents.
+    """
+    # Load fisma specific types
+    ts_fisma = get_fisma_typesystem()
+    term_type = ts_fisma.get_type("com.crosslang.fisma.Term")
+    definition_type = ts_fisma.get_type("com.crosslang.fisma.Definition")
+    defiterm_type = ts_fisma.get_type("com.crosslang.fisma.DefinitionTerm")
+
+    typesystem = get_merged_typesystem()
+
+    django_doc = Document.objects.get(id=document["id"])
 
     # Load CAS files from NLP
-    cas2 = cassis.load_cas_from_xmi(terms_decoded_cas, typesystem=typesystem)
+    if isinstance(terms_decoded_cas, list):
+        # chunked document, offsets are moved so all annotations refer to the concatenated text
+        cas2 = merge_chunk_cases(
+            terms_decoded_cas,
+            typesystem,
+            sofa_id_html2text,
+            [SENTENCE_CLASS, PARAGRAPH_CLASS, TOKEN_CLASS, TFIDF_CLASS, LEMMA_CLASS],
+        )
+    else:
+        cas2 = cassis.load_cas_from_xmi(terms_decoded_cas, typesystem=typesystem)
 
     atomic_update_defined = [
         {
@@ -497,36 +824,42 @@ def extract_terms_for_document(document):
     j = 0
 
     start_cas = time.time()
+    # Index the annotations joined below once, instead of scanning the CAS for every sentence and term
+    view = cas2.get_view(sofa_id_html2text)
+    paragraph_index = AnnotationIndex.from_view(view, PARAGRAPH_CLASS)
+    token_index = AnnotationIndex.from_view(view, TOKEN_CLASS)
+    tfidf_index = AnnotationIndex.from_view(view, TFIDF_CLASS)
+    lemma_index = AnnotationIndex.from_view(view, LEMMA_CLASS)
+
     # Term defined, we check which terms are covered by definitions
     definitions = []
     term_definition_uniq = []
     term_definition_uniq_idx = []
     # Each sentence is a definiton
-    for sentence in cas2.get_view("html2textView").select(SENTENCE_CLASS):
+    for sentence in view.select(SENTENCE_CLASS):
         term_definitions = []
         # Instead of saving sentence, save sentence + context (i.e. paragraph annotation)
-        for par in cas2.get_view(sofa_id_html2text).select_covering(PARAGRAPH_CLASS, sentence):
+        for par in paragraph_index.covering(sentence):
             if (
                 par.begin == sentence.begin
             ):  # if beginning of paragraph == beginning of a definition ==> this detected paragraph should replace the definition
                 sentence = par
         logger.debug("Found definition: %s", sentence.get_covered_text()[0:200])
-        cas2.get_view(sofa_id_html2text).add_annotation(definition_type(begin=sentence.begin, end=sentence.end))
+        view.add_annotation(definition_type(begin=sentence.begin, end=sentence.end))
         # Find terms in definitions
-        for token in cas2.get_view("html2textView").select_covered(TOKEN_CLASS, sentence):
-            # take those tfidf annotations with a cassis.token annotation covering them ==> the terms defined in the definition
-            for term_defined in cas2.get_view("html2textView").select_covering(TFIDF_CLASS, token):
-                if (term_defined.begin == token.begin) and (term_defined.end == token.end):
-                    term_definitions.append((term_defined, sentence))
-                    cas2.get_view(sofa_id_html2text).add_annotation(
-                        defiterm_type(
-                            begin=term_defined.begin,
-                            end=term_defined.end,
-                            term=term_defined.term,
-                            confidence=term_defined.tfidfValue,
-                        )
+        for token in token_index.covered(sentence):
+            # take those tfidf annotations with the same span as a token ==> the terms defined in the definition
+            for term_defined in tfidf_index.exact(token):
+                term_definitions.append((term_defined, sentence))
+                view.add_annotation(
+                    defiterm_type(
+                        begin=term_defined.begin,
+                        end=term_defined.end,
+                        term=term_defined.term,
+                        confidence=term_defined.tfidfValue,
                     )
-                    logger.debug("Found definition term: %s", term_defined.get_covered_text())
+                )
+                logger.debug("Found definition term: %s", term_defined.get_covered_text())
 
         # store terms + definitions in a list of definitions
         definitions.append(term_definitions)
@@ -550,49 +883,23 @@ def extract_terms_for_document(document):
             concept_defined_tokens.insert(j, token_to_add_defined)
             j = j + 1
 
-    # For django
+    # For django, collected here and saved in bulk below
+    defined_groups = []
     for group in definitions:
-        concept_group = []
+        defined_group = []
         for term, definition in group:
-            lemma_name = ""
             token_defined = definition.get_covered_text()
-            start_defined = definition.begin
-            end_defined = definition.end
 
             if len(token_defined.encode("utf-8")) < 32000:
                 if len(term.get_covered_text()) <= 200:
-                    # Save Term Definitions in Django
-                    c = Concept.objects.update_or_create(
-                        name=term.get_covered_text(),
-                        definition=token_defined,
-                        lemma=lemma_name,
-                        version=EXTRACT_TERMS_NLP_VERSION,
-                        defaults={"website_id": django_doc.website.id},
-                    )
-                    concept_group.append(c[0])
-                    defs = ConceptDefined.objects.filter(concept=c[0], document=django_doc)
-                    if len(defs) == 1:
-                        cd = defs[0]
-                        cd.begin = start_defined
-                        cd.end = end_defined
-                        cd.save()
-                    else:
-                        ConceptDefined.objects.create(
-                            concept=c[0], document=django_doc, startOffset=start_defined, endOffset=end_defined
-                        )
+                    defined_group.append((term.get_covered_text(), token_defined, definition.begin, definition.end))
                 else:
                     logger.info(
                         "WARNING: Term '%s' has been skipped because the term name was too long. "
                         "Consider disabling supergrams or change the length in the database",
-                        token,
+                        term.get_covered_text(),
                     )
-        # Link definitions
-        if len(concept_group) > 1:
-            i = 0
-            for from_concept in concept_group[i:]:
-                for to_concept in concept_group[i + 1 :]:
-                    from_concept.other.add(to_concept)
-                i = i + 1
+        defined_groups.append(defined_group)
 
     # Step 5: Send term extractions to Solr (term_occurs field)
 
@@ -607,7 +914,8 @@ def extract_terms_for_document(document):
 
     # Select all Tfidfs from the CAS
     i = 0
-    for term in cas2.get_view(sofa_id_html2text).select(TFIDF_CLASS):
+    occurs = []
+    for term in tfidf_index.annotations:
         # FIXME: check if convered text ends with a space ?
         # Save the token information
         token = term.get_covered_text()
@@ -624,56 +932,24 @@ def extract_terms_for_document(document):
         i = i + 1
 
         # Retrieve the lemma for the term
-        lemma_name = ""
-        for lemma in cas2.get_view(sofa_id_html2text).select_covered(LEMMA_CLASS, term):
-            if term.begin == lemma.begin and term.end == lemma.end:
-                lemma_name = lemma.value
+        lemmas = lemma_index.exact(term)
+        lemma_name = lemmas[-1].value if lemmas else ""
 
         # Store fisma term
-        cas2.get_view(sofa_id_html2text).add_annotation(
+        view.add_annotation(
             term_type(begin=term.begin, end=term.end, term=lemma_name, confidence=term.tfidfValue)
         )
 
-        queryset = Concept.objects.filter(name=term.get_covered_text())
-        if not queryset.exists():
-            # Save Term Definitions in Django
-            if len(term.get_covered_text()) <= 200:
-                c = Concept.objects.update_or_create(
-                    name=term.get_covered_text(),
-                    lemma=lemma_name,
-                    version=EXTRACT_TERMS_NLP_VERSION,
-                    defaults={"website_id": django_doc.website.id},
-                )
-                ConceptOccurs.objects.update_or_create(
-                    concept=c[0],
-                    document=django_doc,
-                    probability=float(score.encode("utf-8")),
-                    startOffset=start,
-                    endOffset=end,
-                )
-
-            else:
-                logger.info(
-                    "WARNING: Term '%s' has been skipped because the term name was too long. "
-                    "Consider disabling supergrams or change the length in the database",
-                    token,
-                )
+        occurs.append((token, lemma_name, float(score), start, end))
 
     logger.info("Complete CAS handling took %s seconds to succeed .", time.time() - start_cas)
 
-    # Step 6: Post term_occurs to Solr
-    escaped_json = json.dumps(atomic_update[0]["concept_occurs"]["set"])
-    atomic_update[0]["concept_occurs"]["set"] = escaped_json
-    logger.info("Detected %s concepts in document: %s", len(concept_occurs_tokens), document["id"])
-    if len(concept_occurs_tokens) > 0:
-        post_pre_analyzed_to_solr(atomic_update)
-
-    # Step 8: Post term_defined to Solr
-    escaped_json_def = json.dumps(atomic_update_defined[0]["concept_defined"]["set"])
-    atomic_update_defined[0]["concept_defined"]["set"] = escaped_json_def
-    logger.info("Detected %s concept definitions in document: %s", len(concept_defined_tokens), document["id"])
-    if len(concept_defined_tokens) > 0:
-        post_pre_analyzed_to_solr(atomic_update_defined)
+    start_django = time.time()
+    with transaction.atomic():
+        lock_concepts()
+        save_concepts_defined(django_doc, defined_groups)
+        save_concepts_occurs(django_doc, occurs)
+    logger.info("Saving concepts took %s seconds to succeed .", time.time() - start_django)
 
     # Clean up annotations for Webanno
     annotations_to_remove = [
@@ -690,12 +966,7 @@ def extract_terms_for_document(document):
             cas2.get_view(sofa_id_html2text).remove_annotation(anno)
 
     # Save CAS to MINIO
-    minio_client = Minio(
-        os.environ["MINIO_STORAGE_ENDPOINT"],
-        access_key=os.environ["MINIO_ACCESS_KEY"],
-        secret_key=os.environ["MINIO_SECRET_KEY"],
-        secure=False,
-    )
+    minio_client = get_minio()
     bucket_name = "cas-files"
     try:
         minio_client.make_bucket(bucket_name)
@@ -707,14 +978,140 @@ def extract_terms_for_document(document):
     logger.info("Created bucket: %s", bucket_name)
     filename = document["id"] + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz"
 
-    file = save_compressed_cas(cas2, filename)
-    logger.info("Saved gzipped cas: %s", file.name)
+    size = put_cas(minio_client, bucket_name, filename, cas2)
+    logger.info("Uploaded gzipped cas to minio: %s (%s bytes)", filename, size)
+
+    # Step 6: Post term_occurs to Solr, last so a document failing above gets no concept fields
+    escaped_json = json.dumps(atomic_update[0]["concept_occurs"]["set"])
+    atomic_update[0]["concept_occurs"]["set"] = escaped_json
+    logger.info("Detected %s concepts in document: %s", len(concept_occurs_tokens), document["id"])
+    with nullcontext(writer) if writer is not None else SolrWriter("documents") as writer:
+        if len(concept_occurs_tokens) > 0:
+            post_pre_analyzed_to_solr(atomic_update, writer)
+
+        # Step 8: Post term_defined to Solr, sent together with term_occurs in one update
+        escaped_json_def = json.dumps(atomic_update_defined[0]["concept_defined"]["set"])
+        atomic_update_defined[0]["concept_defined"]["set"] = escaped_json_def
+        logger.info("Detected %s concept definitions in document: %s", len(concept_defined_tokens), document["id"])
+        if len(concept_defined_tokens) > 0:
+            post_pre_analyzed_to_solr(atomic_update_defined, writer)
+
+
+def lock_concepts():
+    """
+    Serialise the concept writes of parallel batches until the end of the transaction. Concepts have no
+    unique constraint, two batches creating the same concept at the same time would both insert it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CONCEPTS_LOCK_KEY])
+
+
+def save_concepts_defined(django_doc, defined_groups):
+    """
+    Save the terms defined in a document with bulk queries.
+    defined_groups holds a list of (name, definition, begin, end) per definition sentence,
+    the concepts in one group are linked to each other.
+    """
+    names = {name for group in defined_groups for name, _, _, _ in group}
+    if not names:
+        return
+
+    def lookup():
+        # concepts aren't unique, use the oldest one like get() on the first created would
+        found = {}
+        for c in Concept.objects.filter(name__in=names, lemma="", version=EXTRACT_TERMS_NLP_VERSION).order_by("id"):
+            found.setdefault((c.name, c.definition), c)
+        return found
+
+    concepts = lookup()
+    keys = {(name, definition) for group in defined_groups for name, definition, _, _ in group}
+    Concept.objects.filter(pk__in=[concepts[key].pk for key in keys if key in concepts]).update(
+        website_id=django_doc.website_id, updated_at=timezone.now()
+    )
+    new_concepts = [
+        Concept(name=name, definition=definition, lemma="", version=EXTRACT_TERMS_NLP_VERSION,
+                website_id=django_doc.website_id)
+        for name, definition in keys if (name, definition) not in concepts
+    ]
+    for concept in Concept.objects.bulk_create(new_concepts):
+        concepts[(concept.name, concept.definition)] = concept
+
+    # the last offsets of a concept in this document win
+    offsets = {}
+    links = set()
+    for group in defined_groups:
+        group_ids = []
+        for name, definition, begin, end in group:
+            concept_id = concepts[(name, definition)].pk
+            offsets[concept_id] = (begin, end)
+            group_ids.append(concept_id)
+        for i, from_id in enumerate(group_ids):
+            for to_id in group_ids[i + 1 :]:
+                # Concept.other is symmetrical, store both directions
+                links.add((from_id, to_id))
+                links.add((to_id, from_id))
+
+    existing = {}
+    for cd in ConceptDefined.objects.filter(document=django_doc, concept_id__in=offsets):
+        existing.setdefault(cd.concept_id, []).append(cd)
+    to_update = []
+    to_create = []
+    for concept_id, (begin, end) in offsets.items():
+        defs = existing.get(concept_id, [])
+        if len(defs) == 1:
+            cd = defs[0]
+            cd.startOffset = begin
+            cd.endOffset = end
+            to_update.append(cd)
+        else:
+            to_create.append(ConceptDefined(concept_id=concept_id, document=django_doc, startOffset=begin, endOffset=end))
+    ConceptDefined.objects.bulk_update(to_update, ["startOffset", "endOffset"])
+    ConceptDefined.objects.bulk_create(to_create)
+
+    Through = Concept.other.through
+    Through.objects.bulk_create(
+        [Through(from_concept_id=from_id, to_concept_id=to_id) for from_id, to_id in links], ignore_conflicts=True
+    )
 
-    minio_client.fput_object(bucket_name, file.name, filename)
-    logger.info("Uploaded to minio")
 
-    os.remove(file.name)
-    logger.info("Removed file from system")
+def save_concepts_occurs(django_doc, occurs):
+    """
+    Save the first occurrence of each term in a document that isn't a concept yet, with bulk queries.
+    occurs holds (name, lemma, probability, begin, end) in document order.
+    """
+    existing_names = set(
+        Concept.objects.filter(name__in={name for name, _, _, _, _ in occurs}).values_list("name", flat=True)
+    )
+    first_occurs = {}
+    for name, lemma, probability, begin, end in occurs:
+        if name in existing_names or name in first_occurs:
+            continue
+        if len(name) > 200:
+            logger.info(
+                "WARNING: Term '%s' has been skipped because the term name was too long. "
+                "Consider disabling supergrams or change the length in the database",
+                name,
+            )
+            existing_names.add(name)
+            continue
+        first_occurs[name] = (lemma, probability, begin, end)
+    if not first_occurs:
+        return
+
+    concepts = Concept.objects.bulk_create(
+        [
+            Concept(name=name, lemma=lemma, version=EXTRACT_TERMS_NLP_VERSION, website_id=django_doc.website_id)
+            for name, (lemma, _, _, _) in first_occurs.items()
+        ]
+    )
+    ConceptOccurs.objects.bulk_create(
+        [
+            ConceptOccurs(concept_id=concept.pk, document=django_doc, probability=probability,
+                          startOffset=begin, endOffset=end)
+            # postgres returns the ids of the created concepts, in the order they were given
+            for concept, (_, probability, begin, end) in zip(concepts, first_occurs.values())
+        ]
+    )
 
 
 def generate_typesystem_fisma():
@@ -742,22 +1139,14 @@ def send_document_to_webanno(document_id):
     project = projects[0]
     logger.info("PROJECT: %s", project)
     # Load CAS from Minio
-    minio_client = Minio(
-        os.environ["MINIO_STORAGE_ENDPOINT"],
-        access_key=os.environ["MINIO_ACCESS_KEY"],
-        secret_key=os.environ["MINIO_SECRET_KEY"],
-        secure=False,
-    )
+    minio_client = get_minio()
+    # Load typesystems
+    merged_ts = get_merged_typesystem()
     try:
-        cas_gz = minio_client.get_object("cas-files", document_id + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz")
+        cas = get_cas(minio_client, "cas-files", document_id + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz", merged_ts)
     except NoSuchKey:
         return None
 
-    # Load typesystems
-    merged_ts = merge_typesystems(fetch_typesystem(), generate_typesystem_fisma())
-
-    cas = load_compressed_cas(cas_gz, merged_ts)
-
     # # Clean up annotations for Webanno
     SOFA_ID_HTML2TEXT = "html2textView"
     # Modify cas to make html2textview the _InitialView
@@ -790,31 +1179,20 @@ def export_all_user_data(website_id):
     logger.info("Exporting User Annotations to Minio CAS files for website: %s", website_name)
 
     # Load CAS from Minio
-    minio_client = Minio(
-        os.environ["MINIO_STORAGE_ENDPOINT"],
-        access_key=os.environ["MINIO_ACCESS_KEY"],
-        secret_key=os.environ["MINIO_SECRET_KEY"],
-        secure=False,
-    )
+    minio_client = get_minio()
 
     # Load typesystem
-    with open(TYPESYSTEM_USER, "rb") as f:
-        # Generate and write tempfile for typesystem.xml
-        typesystem_user = load_typesystem(f)
-
-    ts_fisma = generate_typesystem_fisma()
-    typesystem = merge_typesystems(typesystem_user, ts_fisma)
+    typesystem_user = get_user_typesystem()
+    typesystem = get_merged_user_typesystem()
 
     for document in documents:
         logger.info("Extracting document: %s", str(document.id))
 
         try:
-            cas_gz = minio_client.get_object(
-                "cas-files", str(document.id) + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz"
+            cas = get_cas(
+                minio_client, "cas-files", str(document.id) + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz", typesystem
             )
 
-            cas = load_compressed_cas(cas_gz, typesystem)
-
             annotations = AnnotationWorklog.objects.filter(document=document)
             for annotation in annotations:
                 user = ""
@@ -842,14 +1220,8 @@ def export_all_user_data(website_id):
                     )
 
             filename = str(document.id) + "-" + EXTRACT_TERMS_NLP_VERSION + ".xml.gz"
-            file = save_compressed_cas(cas, filename)
-            logger.info("Saved gzipped cas: %s", file.name)
-
-            minio_client.fput_object("cas-files", file.name, filename)
-            logger.info("Uploaded to minio")
-
-            os.remove(file.name)
-            logger.info("Removed file from system")
+            put_cas(minio_client, "cas-files", filename, cas)
+            logger.info("Uploaded gzipped cas to minio: %s", filename)
 
         except NoSuchKey:
             pass
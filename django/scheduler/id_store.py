@@ -0,0 +1,75 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# number of ids kept in memory before spilling to a disk-backed store
+ID_STORE_MEMORY_LIMIT = int(os.environ.get('ID_STORE_MEMORY_LIMIT', 1000000))
+
+
+class IdStore:
+    """
+    Set of document ids with O(1) membership tests.
+    Ids are kept in a hash set until memory_limit is reached, after which they are
+    moved to a temporary SQLite table with a primary key index.
+    Lookups are thread-safe once the store has been filled.
+    """
+
+    def __init__(self, memory_limit=ID_STORE_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self._ids = set()
+        self._db = None
+        self._db_file = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, doc_id):
+        if self._db is None:
+            self._ids.add(doc_id)
+            self._size = len(self._ids)
+            if self._size > self.memory_limit:
+                self._spill()
+        else:
+            with self._lock:
+                cursor = self._db.execute('INSERT OR IGNORE INTO ids VALUES (?)', (doc_id,))
+                self._size += cursor.rowcount
+
+    def update(self, doc_ids):
+        for doc_id in doc_ids:
+            self.add(doc_id)
+
+    def __contains__(self, doc_id):
+        if self._db is None:
+            return doc_id in self._ids
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM ids WHERE id = ?', (doc_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self._db_file)
+        self._ids = set()
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _spill(self):
+        logger.info("More than %s ids, moving id store to disk", self.memory_limit)
+        fd, self._db_file = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self._db = sqlite3.connect(self._db_file, check_same_thread=False)
+        self._db.execute('CREATE TABLE ids (id TEXT PRIMARY KEY) WITHOUT ROWID')
+        self._db.executemany('INSERT OR IGNORE INTO ids VALUES (?)', ((doc_id,) for doc_id in self._ids))
+        self._db.commit()
+        self._ids = set()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# documents going through the NLP services at the same time
+NLP_DOCUMENTS_IN_FLIGHT = int(os.environ.get("NLP_DOCUMENTS_IN_FLIGHT", 16))
+# requests in flight per NLP service, override for one service with NLP_CONCURRENCY_<SERVICE>
+NLP_CONCURRENCY = int(os.environ.get("NLP_CONCURRENCY", 4))
+# seconds one attempt of an NLP request may take
+NLP_TIMEOUT = float(os.environ.get("NLP_TIMEOUT", 300))
+NLP_RETRIES = int(os.environ.get("NLP_RETRIES", 2))
+# seconds before the first retry, doubled for every next one
+NLP_RETRY_BACKOFF = float(os.environ.get("NLP_RETRY_BACKOFF", 5))
+
+
+class NlpServiceError(Exception):
+    pass
+
+
+def service_concurrency(service):
+    return int(os.environ.get("NLP_CONCURRENCY_" + service.upper(), NLP_CONCURRENCY))
+
+
+def run_nlp_pipeline(documents, fetch, process):
+    """
+    Run the NLP requests for many documents concurrently and post-process every document once its
+    requests are done.
+    fetch(call, document) is a coroutine that does its requests with await call(service, fn, *args),
+    fn is a blocking function returning a requests Response. Other blocking work, like reading a cache,
+    runs on the same bounded IO threads with await call.io(fn, *args). fetch returns the input for
+    process(document, result), or None to skip the document.
+    process runs on a single worker thread, so it can use the Django ORM and CPU-bound code.
+    Returns the number of processed and skipped documents and a list of (document, exception).
+    """
+    return asyncio.run(_run(documents, fetch, process))
+
+
+async def _run(documents, fetch, process):
+    loop = asyncio.get_running_loop()
+    # every document has at most one request in flight
+    io_executor = ThreadPoolExecutor(max_workers=NLP_DOCUMENTS_IN_FLIGHT, thread_name_prefix="nlp-io")
+    cpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nlp-cpu")
+    # semaphores belong to the running loop, create them here
+    in_flight = asyncio.Semaphore(NLP_DOCUMENTS_IN_FLIGHT)
+    semaphores = {}
+    processed = 0
+    skipped = 0
+    failures = []
+
+    async def call(service, fn, *args):
+        if service not in semaphores:
+            semaphores[service] = asyncio.Semaphore(service_concurrency(service))
+        attempt = 0
+        while True:
+            try:
+                async with semaphores[service]:
+                    response = await asyncio.wait_for(loop.run_in_executor(io_executor, partial(fn, *args)), NLP_TIMEOUT)
+                if response.status_code >= 500:
+                    raise NlpServiceError("%s returned HTTP %s" % (service, response.status_code))
+                return response
+            except (asyncio.TimeoutError, requests.RequestException, NlpServiceError) as err:
+                if attempt >= NLP_RETRIES:
+                    raise
+                delay = NLP_RETRY_BACKOFF * 2 ** attempt
+                attempt += 1
+                logger.warning("NLP service %s failed (%r), retry %d in %s seconds", service, err, attempt, delay)
+                await asyncio.sleep(delay)
+
+    async def io(fn, *args):
+        return await loop.run_in_executor(io_executor, partial(fn, *args))
+
+    call.io = io
+
+    async def handle(document):
+        nonlocal processed, skipped
+        # the slot is kept while the document waits for post-processing, so fetched results don't pile up
+        async with in_flight:
+            try:
+                result = await fetch(call, document)
+                if result is None:
+                    skipped += 1
+                    return
+                await loop.run_in_executor(cpu_executor, process, document, result)
+                processed += 1
+            except Exception as err:
+                logger.exception("NLP pipeline failed for document %s", document.get("id"))
+                failures.append((document, err))
+
+    try:
+        await asyncio.gather(*(handle(document) for document in documents))
+        # database connections are per thread, close the one opened by the post-processing thread
+        await loop.run_in_executor(cpu_executor, connections.close_all)
+    finally:
+        io_executor.shutdown(wait=False)
+        cpu_executor.shutdown(wait=True)
+    logger.info("NLP pipeline: %d documents processed, %d skipped, %d failed", processed, skipped, len(failures))
+    return processed, skipped, failures
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import tempfile
+from io import BytesIO
+
+from minio import ResponseError
+from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
+from tika import parser
+
+logger = logging.getLogger(__name__)
+
+# number of documents parsed by Tika in parallel
+TIKA_PARSE_WORKERS = int(os.environ.get('TIKA_PARSE_WORKERS', 4))
+# documents larger than this are not sent to Tika
+TIKA_MAX_DOCUMENT_BYTES = int(os.environ.get('TIKA_MAX_DOCUMENT_BYTES', 50 * 1024 * 1024))
+# seconds to wait for Tika to parse a single document
+TIKA_PARSE_TIMEOUT = int(os.environ.get('TIKA_PARSE_TIMEOUT', 300))
+# bump when Tika is upgraded so cached plaintext is extracted again
+TIKA_PARSER_VERSION = os.environ.get('TIKA_PARSER_VERSION', '1.24')
+
+PLAINTEXT_CACHE_BUCKET = 'plaintext-cache'
+# files up to this size are kept in memory while hashing, larger ones are spooled to disk
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+def create_plaintext_cache_bucket(minio_client):
+    try:
+        minio_client.make_bucket(PLAINTEXT_CACHE_BUCKET)
+    except BucketAlreadyOwnedByYou:
+        pass
+    except BucketAlreadyExists:
+        pass
+
+
+def plaintext_cache_key(source_hash):
+    """
+    Cached plaintext is keyed by the SHA-256 of the source bytes and the parser version.
+    """
+    return source_hash + '-' + TIKA_PARSER_VERSION + '.txt'
+
+
+def get_cached_plaintext(minio_client, source_hash):
+    try:
+        cached = minio_client.get_object(PLAINTEXT_CACHE_BUCKET, plaintext_cache_key(source_hash))
+    except NoSuchKey:
+        return None
+    try:
+        return cached.data.decode('utf-8')
+    finally:
+        cached.close()
+        cached.release_conn()
+
+
+def store_cached_plaintext(minio_client, source_hash, content_text):
+    if content_text is None:
+        return
+    content_bytes = content_text.encode('utf-8')
+    minio_client.put_object(PLAINTEXT_CACHE_BUCKET, plaintext_cache_key(source_hash), BytesIO(content_bytes),
+                            len(content_bytes), 'text/plain; charset=UTF-8')
+
+
+def parse_html(minio_client, content_html, docid=None):
+    """
+    Extract plaintext from html with Tika, returns None if the html could not be parsed.
+    """
+    content_bytes = content_html.encode('utf-8')
+    if len(content_bytes) > TIKA_MAX_DOCUMENT_BYTES:
+        logger.info("Skipping too big html for: %s", docid)
+        return None
+    source_hash = hashlib.sha256(content_bytes).hexdigest()
+    content_text = get_cached_plaintext(minio_client, source_hash)
+    if content_text is not None:
+        logger.debug("Plaintext cache hit for: %s", docid)
+        return content_text
+    output = parser.from_buffer(content_bytes, requestOptions={'timeout': TIKA_PARSE_TIMEOUT})
+    content_text = output.get('content')
+    store_cached_plaintext(minio_client, source_hash, content_text)
+    return content_text
+
+
+def parse_media_file(minio_client, file_name, docid=None):
+    """
+    Extract plaintext from a file in the media bucket with Tika, returns None if the file could not be parsed.
+    The file is hashed while it is downloaded, Tika is only called when there is no cached plaintext.
+    """
+    bucket_name = os.environ['MINIO_STORAGE_MEDIA_BUCKET_NAME']
+    stat = minio_client.stat_object(bucket_name, file_name)
+    if stat.size > TIKA_MAX_DOCUMENT_BYTES:
+        logger.info("Skipping too big file %s (%s bytes) for: %s", file_name, stat.size, docid)
+        return None
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool:
+        sha256 = hashlib.sha256()
+        file_data = minio_client.get_object(bucket_name, file_name)
+        try:
+            for d in file_data.stream(32 * 1024):
+                sha256.update(d)
+                spool.write(d)
+        finally:
+            file_data.close()
+            file_data.release_conn()
+        source_hash = sha256.hexdigest()
+
+        content_text = get_cached_plaintext(minio_client, source_hash)
+        if content_text is not None:
+            logger.debug("Plaintext cache hit for: %s", docid)
+            return content_text
+
+        spool.seek(0)
+        output = parser.from_buffer(spool, requestOptions={'timeout': TIKA_PARSE_TIMEOUT})
+    content_text = output.get('content')
+    store_cached_plaintext(minio_client, source_hash, content_text)
+    return content_text
+
+
+def parse_solr_document(minio_client, solr_doc):
+    """
+    Extract plaintext from the content_html or single pdf file of a Solr document.
+    """
+    if 'content_html' in solr_doc:
+        return parse_html(minio_client, solr_doc['content_html'][0], solr_doc['id'])
+    # If there is more than 1 pdf, we rely on score_documents to extract
+    # the content of the pdf with the highest score
+    if 'file_name' in solr_doc and len(solr_doc['file_name']) == 1:
+        try:
+            return parse_media_file(minio_client, solr_doc['file_name'][0], solr_doc['id'])
+        except ResponseError as err:
+            logger.error("Could not read %s from minio: %s", solr_doc['file_name'][0], err)
+    return None
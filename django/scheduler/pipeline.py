@@ -0,0 +1,69 @@
+import logging
+from contextlib import contextmanager
+
+from celery import current_task
+from django.db.models import F
+from django.utils import timezone
+
+from searchapp.models import PipelineRun
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def pipeline_stage(website_id, stage, run_id=None, fan_out=False):
+    """
+    Record a PipelineRun for the stage executed in the with block.
+    The stage fills in documents_in, documents_out and errors on the yielded record,
+    timestamps and an exception escaping the block are recorded automatically.
+    With fan_out the stage only dispatches batch tasks: the run is left open when it has documents,
+    the batches report with finish_fan_out_batch and the last one finishes the run.
+    """
+    run = PipelineRun(website_id=website_id, stage=stage)
+    if run_id:
+        run.run_id = run_id
+    if current_task:
+        run.task_id = current_task.request.id
+    run.save()
+    failed = False
+    try:
+        yield run
+    except Exception as err:
+        failed = True
+        run.errors += 1
+        run.error_message = repr(err)
+        raise
+    finally:
+        if fan_out and not failed and run.documents_in > 0:
+            run.save()
+            logger.info("Stage %s for website %s: dispatched %s documents", stage, website_id, run.documents_in)
+        else:
+            run.finished_at = timezone.now()
+            run.save()
+            logger.info("Stage %s for website %s: %s documents in, %s out, %s errors in %.1f seconds",
+                        stage, website_id, run.documents_in, run.documents_out, run.errors, run.duration)
+
+
+def finish_fan_out_batch(run_pk, documents_out, errors, batch_size):
+    """
+    Add the counts of a batch task of batch_size documents to a run left open by pipeline_stage with fan_out.
+    Returns True for the batch that completed the run, it sets the end time.
+    """
+    if documents_out + errors > batch_size:
+        # a document counted twice would finish the run before its last batch
+        logger.warning("Batch of run %s reported %s documents out and %s errors for %s documents",
+                       run_pk, documents_out, errors, batch_size)
+        errors = min(errors, batch_size)
+        documents_out = batch_size - errors
+    PipelineRun.objects.filter(pk=run_pk).update(
+        documents_out=F('documents_out') + documents_out, errors=F('errors') + errors)
+    run = PipelineRun.objects.get(pk=run_pk)
+    if run.finished_at is not None or run.documents_out + run.errors < run.documents_in:
+        return False
+    # only one of the batches finishing at the same time wins
+    if not PipelineRun.objects.filter(pk=run_pk, finished_at=None).update(finished_at=timezone.now()):
+        return False
+    run.refresh_from_db()
+    logger.info("Stage %s for website %s: %s documents in, %s out, %s errors in %.1f seconds",
+                run.stage, run.website_id, run.documents_in, run.documents_out, run.errors, run.duration)
+    return True
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def imap_bounded(fn, iterable, workers):
+    """
+    Apply fn to every item of iterable in a pool of worker threads.
+    The iterable is consumed lazily: at most 2 * workers items are in flight at any
+    time, so memory stays bounded regardless of the number of items.
+    Yields (item, result, error) tuples in order of completion, error is None on success.
+    """
+    workers = max(1, int(workers))
+    max_in_flight = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for item in iterable:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _completed(pending.pop(future), future)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield _completed(pending.pop(future), future)
+
+
+def _completed(item, future):
+    error = future.exception()
+    if error is not None:
+        return item, None, error
+    return item, future.result(), None
@@ -0,0 +1,107 @@
+import logging
+import uuid
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from searchapp.models import DocumentProcessingState, ProcessingStatus
+
+logger = logging.getLogger(__name__)
+
+STAGE_PARSE = 'parse_content'
+STAGE_SCORE = 'score'
+STAGE_EXTRACT_TERMS = 'extract_terms'
+STAGE_EXTRACT_RO = 'extract_ro'
+
+# the stages that depend on the content of a document
+CONTENT_STAGES = [STAGE_PARSE, STAGE_EXTRACT_TERMS, STAGE_EXTRACT_RO]
+
+# documents checked per query by skip_done
+SKIP_DONE_BATCH_SIZE = 250
+
+
+def done_document_ids(document_ids, stage, version):
+    """
+    Ids of the documents that were processed by the stage with this version.
+    """
+    return set(str(document_id) for document_id in DocumentProcessingState.objects.filter(
+        document_id__in=document_ids, stage=stage, version=version, status=ProcessingStatus.DONE
+    ).values_list('document_id', flat=True))
+
+
+def skip_done(documents, stage, version, batch_size=SKIP_DONE_BATCH_SIZE):
+    """
+    Yield the Solr documents that are pending or failed for the stage with this version,
+    documents are checked in batches of batch_size.
+    """
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield from _pending(batch, stage, version)
+            batch = []
+    yield from _pending(batch, stage, version)
+
+
+def _pending(batch, stage, version):
+    done = done_document_ids([document['id'] for document in batch], stage, version)
+    if done:
+        logger.info("Skipping %d documents already done for %s", len(done), stage)
+    return [document for document in batch if document['id'] not in done]
+
+
+def mark_documents(website_id, document_ids, stage, version, status, error=None):
+    """
+    Record the status of the documents for the stage, with one update and one insert query.
+    Marking documents as running counts an attempt.
+    """
+    document_ids = [uuid.UUID(str(document_id)) for document_id in document_ids]
+    if not document_ids:
+        return
+    now = timezone.now()
+    values = {'status': status, 'version': version, 'error': error, 'updated_at': now}
+    if status == ProcessingStatus.RUNNING:
+        values.update(started_at=now, finished_at=None, attempts=F('attempts') + 1)
+    elif status in (ProcessingStatus.DONE, ProcessingStatus.FAILED):
+        values.update(finished_at=now)
+    with transaction.atomic():
+        states = DocumentProcessingState.objects.filter(document_id__in=document_ids, stage=stage)
+        existing = set(states.values_list('document_id', flat=True))
+        states.update(**values)
+        DocumentProcessingState.objects.bulk_create([
+            DocumentProcessingState(
+                document_id=document_id, website_id=website_id, stage=stage, status=status, version=version,
+                error=error, attempts=1 if status == ProcessingStatus.RUNNING else 0,
+                started_at=now if status == ProcessingStatus.RUNNING else None,
+                finished_at=now if status in (ProcessingStatus.DONE, ProcessingStatus.FAILED) else None,
+            )
+            for document_id in document_ids if document_id not in existing
+        ], ignore_conflicts=True)
+
+
+def mark_done(website_id, document_ids, stage, version):
+    mark_documents(website_id, document_ids, stage, version, ProcessingStatus.DONE)
+
+
+def mark_failed(website_id, document_ids, stage, version, error):
+    mark_documents(website_id, document_ids, stage, version, ProcessingStatus.FAILED,
+                   error if isinstance(error, str) else repr(error))
+
+
+def mark_running(website_id, document_ids, stage, version):
+    mark_documents(website_id, document_ids, stage, version, ProcessingStatus.RUNNING)
+
+
+def reset_documents(document_ids, stages):
+    """
+    Forget the state of the documents for the stages, so the next run processes them again.
+    """
+    document_ids = [uuid.UUID(str(document_id)) for document_id in document_ids]
+    if not document_ids:
+        return
+    DocumentProcessingState.objects.filter(document_id__in=document_ids, stage__in=stages).delete()
+
+
+def reset_website(website_id, stages):
+    DocumentProcessingState.objects.filter(website_id=website_id, stage__in=stages).delete()
@@ -6,29 +6,38 @@ import json
 import logging
 import os
 import shutil
-import csv
+import uuid
 from datetime import datetime, timedelta
 from io import BytesIO
 from pathlib import Path
 
-import pysolr
 from celery import shared_task, chain
-from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.functions import Length
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from jsonlines import jsonlines
-from minio import Minio, ResponseError
+from minio import ResponseError
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists
 from scrapy.crawler import CrawlerRunner
 from scrapy.utils.project import get_project_settings
-from tika import parser
 from twisted.internet import reactor
 
 from scheduler.extract import extract_terms, extract_reporting_obligations, export_all_user_data, \
     export_public_services, export_contact_points, export_websites_from_rdf
-from searchapp.datahandling import score_documents
-from searchapp.models import Website, Document, AcceptanceState, Tag, AcceptanceStateValue
-from searchapp.solr_call import solr_search_website_sorted, solr_search_website_with_content
+from scheduler.id_store import IdStore
+from scheduler.parsing import parse_solr_document, create_plaintext_cache_bucket, TIKA_PARSE_WORKERS, \
+    TIKA_PARSER_VERSION
+from scheduler.pipeline import pipeline_stage
+from scheduler.processing_state import skip_done, mark_done, mark_failed, reset_documents, reset_website, \
+    STAGE_PARSE, STAGE_EXTRACT_TERMS, CONTENT_STAGES
+from scheduler.pool import imap_bounded
+from searchapp.datahandling import score_documents, update_documents_unvalidated, stale_validated_documents
+from searchapp.clients import get_solr, get_minio
+from searchapp.models import Website, Document, AcceptanceState, Tag, AcceptanceStateValue, DocumentProcessingState
+from searchapp.solr_call import solr_search_website_sorted, solr_search_website_with_content, solr_search_cursor
+from searchapp.solr_writer import SolrWriter
 
 from glossary.models import Concept, ConceptOccurs, ConceptDefined, AnnotationWorklog
 from glossary.models import AcceptanceState as ConceptAcceptanceState
@@ -43,6 +52,17 @@ workpath = os.path.dirname(os.path.abspath(__file__
 CONST_EXPORT = '/export/'
 QUERY_ID_ASC = 'id asc'
 QUERY_WEBSITE = "website:"
+# number of MinIO jsonlines files synced to Solr in parallel
+SYNC_SCRAPY_WORKERS = int(os.environ.get('SYNC_SCRAPY_WORKERS', 4))
+# scraped fields the content dependent stages read, an update with one of them resets those stages
+SCRAPY_CONTENT_FIELDS = ['content_html', 'file_name', 'content']
+# parsed documents are posted to Solr in batches of this size
+PARSE_CONTENT_FLUSH = 100
+# number of documents written per query by sync_documents_task
+SYNC_DOCUMENTS_BATCH_SIZE = 1000
+SYNC_DOCUMENT_FIELDS = ['author', 'celex', 'language', 'consolidated_versions', 'date', 'date_of_effect',
+                        'date_last_update', 'eli', 'file_url', 'status', 'summary', 'title', 'title_prefix', 'type',
+                        'url', 'various', 'website']
 
 
 @shared_task
@@ -54,15 +74,18 @@ def full_service_task(website_id, **kwargs):
     # a task only starts after the previous finished, immutable signatures (si)
     # are used since a task doesn't need the result of the previous task: see
     # https://docs.celeryproject.org/en/stable/userguide/canvas.html
+    # every stage records a PipelineRun, grouped by run_id
+    run_id = str(uuid.uuid4())
     chain(
-        sync_scrapy_to_solr_task.si(website_id),
+        sync_scrapy_to_solr_task.si(website_id, run_id=run_id),
         parse_content_to_plaintext_task.si(
-            website_id, date=kwargs.get('date', None)),
-        sync_documents_task.si(website_id, date=kwargs.get('date', None)),
-        score_documents_task.si(website_id, date=kwargs.get('date', None)),
-        check_documents_unvalidated_task.si(website_id),
-        extract_terms.si(website_id),
+            website_id, date=kwargs.get('date', None), run_id=run_id),
+        sync_documents_task.si(website_id, date=kwargs.get('date', None), run_id=run_id),
+        score_documents_task.si(website_id, date=kwargs.get('date', None), run_id=run_id),
+        check_documents_unvalidated_task.si(website_id, run_id=run_id),
+        extract_terms.si(website_id, run_id=run_id),
     )()
+    return run_id
 
 
 @shared_task
@@ -83,13 +106,11 @@ def delete_deprecated_acceptance_states():
 
 def reset_pre_analyzed_fields_document(document_id):
     logger.info("Resetting all PreAnalyzed fields for DOCUMENT: %s", document_id)
-    core = 'documents'
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    document = {"id": document_id,
-                "concept_occurs": {"set": ""},
-                "concept_defined": {"set": ""}
-                }
-    client.add(document, commit=True)
+    with SolrWriter() as writer:
+        writer.set_fields(document_id, concept_occurs="", concept_defined="")
+        writer.commit()
+    # extract_terms skips documents that are done
+    reset_documents([document_id], [STAGE_EXTRACT_TERMS])
 
 
 @shared_task
@@ -98,33 +119,18 @@ def reset_pre_analyzed_fields(website_id):
     logger.info("Resetting all PreAnalyzed fields for WEBSITE: %s", website.name)
 
     website_name = website.name.lower()
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
     core = 'documents'
     # select all records where content is empty and content_html is not
     q = "( concept_occurs: [* TO *] OR concept_defined: [* TO *] ) AND website:" + website_name
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    options = {'rows': rows_per_page, 'start': page_number,
-               'cursorMark': cursor_mark, 'sort': QUERY_ID_ASC}
-    results = client.search(q, **options)
-    items = []
+    results = solr_search_cursor(core, q, fl='id')
 
-    for result in results:
-        # add to document model and save
-        document = {"id": result['id'],
-                    "concept_occurs": {"set": ""},
-                    "concept_defined": {"set": ""}
-                    }
-        items.append(document)
-
-        if len(items) == 1000:
-            logger.info("Got 1000 items, posting to solr")
-            client.add(items, commit=True)
-            items = []
-
-    # Send to solr
-    client.add(items, commit=True)
+    with SolrWriter(core) as writer:
+        for result in results:
+            writer.set_fields(result['id'], concept_occurs="", concept_defined="")
+        # term extraction selects documents with an empty concept_occurs field
+        writer.commit()
+    # and skips documents that are done
+    reset_website(website_id, [STAGE_EXTRACT_TERMS])
 
 
 @shared_task
@@ -139,7 +145,7 @@ def export_documents():
         .order_by("document")
 
     core = 'documents'
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     workdir = workpath + CONST_EXPORT + export_documents.request.id
     os.makedirs(workdir)
 
@@ -187,8 +193,7 @@ def export_documents():
                         CONST_EXPORT + export_documents.request.id)
 
     # upload zip to minio
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+    minio_client = get_minio()
     try:
         minio_client.make_bucket('export')
     except BucketAlreadyOwnedByYou as err:
@@ -216,14 +221,12 @@ def handle_document_updates_task(website_id):
     website = Website.objects.get(pk=website_id)
     logger.info("Handle updates for WEBSITE: %s", str(website))
     # process files from minio
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+    minio_client = get_minio()
     bucket_name = website.name.lower()
     # get all content_hashes
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + 'documents')
-    client_archive = pysolr.Solr(os.environ['SOLR_URL'] + '/' + 'archive')
-    options = {'rows': 250000, 'fl': 'id,content_hash'}
-    results = client.search("*:*", **options)
+    client = get_solr('documents')
+    archive_writer = SolrWriter('archive')
+    results = solr_search_cursor('documents', "*:*", fl='id,content_hash')
     content_hashes = {}
     for result in results:
         if 'content_hash' in result:
@@ -258,19 +261,19 @@ def handle_document_updates_task(website_id):
                     del result['_version_']
                     updates.append(result)
                 # send results to archive
-                client_archive.add(updates, commit=True)
+                archive_writer.add(updates)
                 updates = []
 
     except ResponseError as err:
         raise
+    finally:
+        archive_writer.close()
 
 
 @shared_task
 def get_stats_for_html_size(website_id):
     core = 'documents'
-    page_number = 0
     rows_per_page = 250
-    cursor_mark = "*"
 
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
@@ -278,10 +281,7 @@ def get_stats_for_html_size(website_id):
         " AND content_html:* AND acceptance_state:accepted"
 
     # Load all documents from Solr
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    options = {'rows': rows_per_page, 'start': page_number,
-               'cursorMark': cursor_mark, 'sort': QUERY_ID_ASC, 'fl': 'content_html,id'}
-    documents = client.search(q, **options)
+    documents = solr_search_cursor(core, q, fl='content_html,id', rows=rows_per_page)
 
     size_1 = 0
     size_2 = 0
@@ -303,9 +303,10 @@ def score_documents_task(website_id, language, **kwargs):
     # lookup documents for website and score them
     website = Website.objects.get(pk=website_id)
     logger.info("Scoring documents with WEBSITE: " + website.name)
-    solr_documents = solr_search_website_with_content(
-        'documents', website.name, language, date=kwargs.get('date', None))
-    score_documents(website.name, solr_documents)
+    with pipeline_stage(website_id, 'score_documents', kwargs.get('run_id')) as run:
+        solr_documents = solr_search_website_with_content(
+            'documents', website.name, language, date=kwargs.get('date', None))
+        run.documents_in, run.documents_out, run.errors = score_documents(website.name, solr_documents)
 
 
 @shared_task
@@ -315,92 +316,175 @@ def sync_documents_task(website_id, **kwargs):
     logger.info("Syncing documents with WEBSITE: " + website.name)
     # query Solr for available documents and sync with Django
 
-    date = kwargs.get('date', None)
-    solr_documents = solr_search_website_sorted(
-        core='documents', website=website.name.lower(), date=date)
-    for solr_doc in solr_documents:
-
-        solr_doc_date_types = solr_doc.get('dates_type', [''])
-        solr_doc_date_dates = solr_doc.get('dates', [''])
-        solr_doc_date_info = solr_doc.get('dates_info', [''])
-
-        solr_doc_date_of_effect = None
-        for date_info in solr_doc_date_info:
-            if date_info.lower().startswith("entry into force"):
-                index = solr_doc_date_info.index(date_info)
-                if solr_doc_date_types[index] == "date of effect":
-                    solr_doc_date_of_effect = solr_doc_date_dates[index]
-                    break
-
-        solr_doc_date = solr_doc.get('date', [datetime.now()])[0]
-        solr_doc_date_last_update = solr_doc.get(
-            'date_last_update', datetime.now())
-        # sanity check in case date_last_update was a solr array field
-        if isinstance(solr_doc_date_last_update, list):
-            solr_doc_date_last_update = solr_doc_date_last_update[0]
-        data = {
-            "author": solr_doc.get('misc_author', [''])[0][:20],
-            "celex": solr_doc.get('celex', [''])[0][:20],
-            "language": solr_doc.get('language', ''),
-            "consolidated_versions": ','.join(x.strip() for x in solr_doc.get('consolidated_versions', [''])),
-            "date": solr_doc_date,
-            "date_of_effect": solr_doc_date_of_effect,
-            "date_last_update": solr_doc_date_last_update,
-            "eli": solr_doc.get('eli', [''])[0],
-            "file_url": solr_doc.get('file_url', [None])[0],
-            "status": solr_doc.get('status', [''])[0][:100],
-            "summary": ''.join(x.strip() for x in solr_doc.get('summary', [''])),
-            "title": solr_doc.get('title', [''])[0][:1000],
-            "title_prefix": solr_doc.get('title_prefix', [''])[0],
-            "type": solr_doc.get('type', [''])[0],
-            "url": solr_doc['url'][0],
-            "various": ''.join(x.strip() for x in solr_doc.get('various', [''])),
-            "website": website,
-        }
-        # Update or create the document, this returns a tuple with the django document and a boolean indicating
-        # whether or not the document was created
-        current_doc, current_doc_created = Document.objects.update_or_create(
-            id=solr_doc["id"], defaults=data)
-
-    if not date:
-        # check for outdated documents based on last time a document was found during scraping
-        how_many_days = 30
-        outdated_docs = Document.objects.filter(
-            date_last_update__lte=datetime.now() - timedelta(days=how_many_days))
-        up_to_date_docs = Document.objects.filter(
-            date_last_update__gte=datetime.now() - timedelta(days=how_many_days))
-        # tag documents that have not been updated in a while
-        for doc in outdated_docs:
-            try:
-                Tag.objects.create(value="OFFLINE", document=doc)
-            except ValidationError as e:
-                # tag exists, skip
-                logger.debug(str(e))
-        # untag if the documents are now up to date
-        for doc in up_to_date_docs:
-            # fetch OFFLINE tag for this document
-            try:
-                offline_tag = Tag.objects.filter(value="OFFLINE", document=doc)
-                offline_tag.delete()
-            except Tag.DoesNotExist:
-                # OFFLINE tag not found, skip
-                pass
+    with pipeline_stage(website_id, 'sync_documents', kwargs.get('run_id')) as run:
+        date = kwargs.get('date', None)
+        solr_documents = solr_search_website_sorted(
+            core='documents', website=website.name.lower(), date=date)
+        created = 0
+        updated = 0
+        skipped = 0
+        batch = []
+        for solr_doc in solr_documents:
+            run.documents_in += 1
+            batch.append((solr_doc["id"], solr_doc_to_document_data(solr_doc, website)))
+            if len(batch) == SYNC_DOCUMENTS_BATCH_SIZE:
+                batch_created, batch_updated, batch_skipped = bulk_upsert_documents(batch)
+                created += batch_created
+                updated += batch_updated
+                skipped += batch_skipped
+                batch = []
+        batch_created, batch_updated, batch_skipped = bulk_upsert_documents(batch)
+        created += batch_created
+        updated += batch_updated
+        skipped += batch_skipped
+        run.documents_out = created + updated
+        run.errors = skipped
+        logger.info("Synced documents for WEBSITE: %s (%s created, %s updated, %s skipped)",
+                    website.name, created, updated, skipped)
+
+        if not date:
+            # check for outdated documents based on last time a document was found during scraping
+            how_many_days = 30
+            outdated_docs = Document.objects.filter(
+                date_last_update__lte=datetime.now() - timedelta(days=how_many_days))
+            up_to_date_docs = Document.objects.filter(
+                date_last_update__gte=datetime.now() - timedelta(days=how_many_days))
+            # tag documents that have not been updated in a while, unless they are tagged already
+            untagged_ids = outdated_docs.exclude(tags__value="OFFLINE").values_list('id', flat=True)
+            Tag.objects.bulk_create((Tag(value="OFFLINE", document_id=doc_id) for doc_id in untagged_ids.iterator()),
+                                    batch_size=SYNC_DOCUMENTS_BATCH_SIZE)
+            # untag if the documents are now up to date
+            Tag.objects.filter(value="OFFLINE", document__in=up_to_date_docs).delete()
+
+
+def solr_doc_to_document_data(solr_doc, website):
+    solr_doc_date_types = solr_doc.get('dates_type', [''])
+    solr_doc_date_dates = solr_doc.get('dates', [''])
+    solr_doc_date_info = solr_doc.get('dates_info', [''])
+
+    solr_doc_date_of_effect = None
+    for date_info in solr_doc_date_info:
+        if date_info.lower().startswith("entry into force"):
+            index = solr_doc_date_info.index(date_info)
+            if solr_doc_date_types[index] == "date of effect":
+                solr_doc_date_of_effect = solr_doc_date_dates[index]
+                break
+
+    solr_doc_date = solr_doc.get('date', [datetime.now()])[0]
+    solr_doc_date_last_update = solr_doc.get(
+        'date_last_update', datetime.now())
+    # sanity check in case date_last_update was a solr array field
+    if isinstance(solr_doc_date_last_update, list):
+        solr_doc_date_last_update = solr_doc_date_last_update[0]
+    return {
+        "author": solr_doc.get('misc_author', [''])[0][:20],
+        "celex": solr_doc.get('celex', [''])[0][:20],
+        "language": solr_doc.get('language', ''),
+        "consolidated_versions": ','.join(x.strip() for x in solr_doc.get('consolidated_versions', [''])),
+        "date": solr_doc_date,
+        "date_of_effect": solr_doc_date_of_effect,
+        "date_last_update": solr_doc_date_last_update,
+        "eli": solr_doc.get('eli', [''])[0],
+        "file_url": solr_doc.get('file_url', [None])[0],
+        "status": solr_doc.get('status', [''])[0][:100],
+        "summary": ''.join(x.strip() for x in solr_doc.get('summary', [''])),
+        "title": solr_doc.get('title', [''])[0][:1000],
+        "title_prefix": solr_doc.get('title_prefix', [''])[0],
+        "type": solr_doc.get('type', [''])[0],
+        "url": solr_doc['url'][0],
+        "various": ''.join(x.strip() for x in solr_doc.get('various', [''])),
+        "website": website,
+    }
+
+
+def bulk_upsert_documents(batch):
+    """
+    Create or update a batch of (id, data) document tuples with a constant number of queries.
+    Existing documents are only written when one of their synced fields changed.
+    Documents whose url belongs to another document are skipped.
+    Returns a (created, updated, skipped) tuple of counts.
+    """
+    if not batch:
+        return 0, 0, 0
+    existing_docs = Document.objects.in_bulk([uuid.UUID(doc_id) for doc_id, _ in batch])
+    to_create = []
+    to_update = []
+    now = timezone.now()
+    for doc_id, data in batch:
+        django_doc = existing_docs.get(uuid.UUID(doc_id))
+        if django_doc is None:
+            to_create.append(Document(id=doc_id, **data))
+            continue
+        changed = False
+        for field_name, value in data.items():
+            if field_name == 'website':
+                if django_doc.website_id != value.id:
+                    django_doc.website = value
+                    changed = True
+            elif getattr(django_doc, field_name) != normalize_field_value(field_name, value):
+                setattr(django_doc, field_name, value)
+                changed = True
+        if changed:
+            django_doc.updated_at = now
+            to_update.append(django_doc)
+
+    # url is unique, resolve conflicts with other documents and within the batch before writing
+    url_owners = dict(Document.objects.filter(url__in=[doc.url for doc in to_create + to_update])
+                      .exclude(pk__in=[doc.pk for doc in to_create + to_update]).values_list('url', 'id'))
+    to_create, skipped_create = claim_urls(to_create, url_owners)
+    to_update, skipped_update = claim_urls(to_update, url_owners)
+    for doc in skipped_create + skipped_update:
+        logger.warning("Skipping document %s, its url %s belongs to document %s", doc.pk, doc.url,
+                       url_owners[doc.url])
+
+    with transaction.atomic():
+        # rows dropped by a conflict with a concurrent sync are not counted as created
+        Document.objects.bulk_create(to_create, ignore_conflicts=True)
+        created = Document.objects.filter(pk__in=[doc.pk for doc in to_create],
+                                          url__in=[doc.url for doc in to_create]).count()
+        Document.objects.bulk_update(to_update, SYNC_DOCUMENT_FIELDS + ['updated_at'])
+    skipped = len(skipped_create) + len(skipped_update) + len(to_create) - created
+    return created, len(to_update), skipped
+
+
+def claim_urls(docs, url_owners):
+    """
+    Split docs in the documents whose url is free and the ones whose url is owned by another document.
+    url_owners is updated with the claimed urls.
+    """
+    claimed = []
+    skipped = []
+    for doc in docs:
+        if doc.url in url_owners and url_owners[doc.url] != doc.pk:
+            skipped.append(doc)
+        else:
+            url_owners[doc.url] = doc.pk
+            claimed.append(doc)
+    return claimed, skipped
+
+
+def normalize_field_value(field_name, value):
+    # convert incoming Solr values the same way Django does when loading them from the database
+    value = Document._meta.get_field(field_name).to_python(value)
+    if isinstance(value, datetime) and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
 
 
 @shared_task
 def delete_documents_not_in_solr_task(website_id):
     website = Website.objects.get(pk=website_id)
-    # query Solr for available documents
-    solr_documents = solr_search_website_sorted(
-        core='documents', website=website.name.lower())
-    # delete django Documents that no longer exist in Solr
-    django_documents = list(Document.objects.filter(website=website))
-    django_doc_ids = [str(django_doc.id) for django_doc in django_documents]
-    solr_doc_ids = [solr_doc["id"] for solr_doc in solr_documents]
-    to_delete_doc_ids = set(django_doc_ids) - set(solr_doc_ids)
+    with IdStore() as solr_doc_ids:
+        # query Solr for available documents, one page of ids at a time
+        solr_doc_ids.update(solr_doc["id"] for solr_doc in solr_search_website_sorted(
+            core='documents', website=website.name.lower(), fl='id'))
+        # delete django Documents that no longer exist in Solr
+        django_doc_ids = Document.objects.filter(website=website).values_list('id', flat=True)
+        to_delete_doc_ids = [doc_id for doc_id in django_doc_ids.iterator() if str(doc_id) not in solr_doc_ids]
     to_delete_docs = Document.objects.filter(pk__in=to_delete_doc_ids)
-    logger.info('Deleting deprecated documents...')
+    logger.info('Deleting %s deprecated documents...', len(to_delete_doc_ids))
     to_delete_docs.delete()
+    DocumentProcessingState.objects.filter(document_id__in=to_delete_doc_ids).delete()
 
 
 @shared_task
@@ -509,128 +593,143 @@ def parse_content_to_plaintext_task(website_id, **kwargs):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     logger.info('Adding content to each %s document.', website_name)
-    page_number = 0
     rows_per_page = 250
-    cursor_mark = "*"
     date = kwargs.get('date', None)
     # select all records where content is empty and content_html is not
     q = "-content: [\"\" TO *] AND ( content_html: [* TO *] OR file_name: [* TO *] ) AND website:" + website_name
     if date:
         q = q + " AND date:[" + date + " TO NOW]"  # eg. 2013-07-17T00:00:00Z
 
-    core = 'documents'
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    options = {'rows': rows_per_page, 'start': page_number,
-               'cursorMark': cursor_mark, 'sort': QUERY_ID_ASC}
-    results = client.search(q, **options)
-    items = []
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
-    for result in results:
-        # Parse content
-        content_text = None
-        if 'content_html' in result:
-            output = parser.from_buffer(result['content_html'][0])
-            content_text = output['content']
-        elif 'file_name' in result:
-            # If there is more than 1 pdf, we rely on score_documents to extract
-            # the content of the pdf with the highest score
-            if len(result['file_name']) == 1:
-                try:
-                    file_data = minio_client.get_object(
-                        os.environ['MINIO_STORAGE_MEDIA_BUCKET_NAME'], result['file_name'][0])
-                    output = BytesIO()
-                    for d in file_data.stream(32 * 1024):
-                        output.write(d)
-                    content_text = parser.from_buffer(output.getvalue())
-                    if 'content' in content_text:
-                        content_text = content_text['content']
-                except ResponseError as err:
-                    print(err)
-
-        # Store plaintext
-        if content_text is None:
-            # could not parse content
-            logger.info(
-                'No output for: %s, removing content', result['id'])
-        else:
-            logger.debug('Got content for: %s (%s)',
-                         result['id'], len(content_text))
-
-        # add to document model and save
-        document = {"id": result['id'],
-                    "content": {"set": content_text}}
-        items.append(document)
+    with pipeline_stage(website_id, 'parse_content_to_plaintext', kwargs.get('run_id')) as run:
+        core = 'documents'
+        writer = SolrWriter(core, batch_size=PARSE_CONTENT_FLUSH)
+        # documents Tika couldn't get content from stay without content, skip them until Tika is upgraded
+        results = skip_done(solr_search_cursor(core, q, fl='id,content_html,file_name', rows=rows_per_page),
+                            STAGE_PARSE, TIKA_PARSER_VERSION)
+        minio_client = get_minio()
+        create_plaintext_cache_bucket(minio_client)
+        done_ids = []
+        # Parse content, documents are handled in order of completion so a slow pdf doesn't hold up the others
+        for result, content_text, err in imap_bounded(lambda result: parse_solr_document(minio_client, result),
+                                                      results, TIKA_PARSE_WORKERS):
+            run.documents_in += 1
+            if err is not None:
+                logger.error('Failed to parse content for: %s: %s', result['id'], err)
+                run.errors += 1
+                mark_failed(website_id, [result['id']], STAGE_PARSE, TIKA_PARSER_VERSION, err)
+                continue
+
+            # Store plaintext
+            if content_text is None:
+                # could not parse content
+                logger.info(
+                    'No output for: %s, removing content', result['id'])
+            else:
+                logger.debug('Got content for: %s (%s)',
+                             result['id'], len(content_text))
+                run.documents_out += 1
 
-        if len(items) == 1000:
-            logger.info("Got 1000 items, posting to solr")
-            client.add(items, commit=True)
-            items = []
+            # add to document model and save
+            writer.set_fields(result['id'], content=content_text)
+            done_ids.append(result['id'])
+            if len(done_ids) >= PARSE_CONTENT_FLUSH:
+                # only documents whose content was sent to Solr are done
+                writer.flush()
+                mark_done(website_id, done_ids, STAGE_PARSE, TIKA_PARSER_VERSION)
+                done_ids = []
 
-    # Send to solr
-    client.add(items, commit=True)
+        # scoring selects documents by their content
+        writer.commit()
+        mark_done(website_id, done_ids, STAGE_PARSE, TIKA_PARSER_VERSION)
 
 
 @shared_task
-def sync_scrapy_to_solr_task(website_id):
+def sync_scrapy_to_solr_task(website_id, run_id=None):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     logger.info("Scrapy to Solr WEBSITE: %s", str(website))
     # process files from minio
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+    minio_client = get_minio()
     bucket_name = website.name.lower()
     bucket_archive_name = bucket_name + "-archive"
     create_bucket(minio_client, bucket_name)
     create_bucket(minio_client, bucket_archive_name)
     core = "documents"
 
-    # Fetch existing id's
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    options = {'rows': 250000, 'fl': 'id'}
-    results = client.search("website: " + website_name, **options)
-    content_ids = []
-    for result in results:
-        content_ids.append(result['id'])
-    logger.info("Found " + str(len(content_ids)) + " ids")
+    failed = []
+    with pipeline_stage(website_id, 'sync_scrapy_to_solr', run_id) as run, \
+            IdStore() as content_ids, SolrWriter(core) as writer:
+        # Fetch existing id's, one page at a time
+        content_ids.update(doc['id'] for doc in solr_search_cursor(core, QUERY_WEBSITE + website_name, fl='id'))
+        logger.info("Found " + str(len(content_ids)) + " ids")
 
-    try:
+        # jsonlines files are independent of each other, process them in parallel
         objects = minio_client.list_objects(bucket_name)
-        for obj in objects:
-            # Fetch jsonlines file
-            logger.info("Working on %s", obj.object_name)
-            file_data = minio_client.get_object(bucket_name, obj.object_name)
-            updated_items = 0
-            new_items = 0
-            results = []
-            # a json-line file may contain up to 1000 json documents (memory issue ?)
-            with jsonlines.Reader(BytesIO(file_data.data)) as reader:
-                for json in reader:
-                    if json['id'] in content_ids:
-                        updated_items = updated_items + 1
-                        results.append(rewrite_json_doc_to_update(json))
-                    else:
-                        new_items = updated_items + 1
-                        results.append(json)
-                    if len(results) == 1000:
-                        # Update solr index
-                        client.add(results, commit=True)
-                        results = []
+        for obj, result, err in imap_bounded(
+                lambda obj: sync_scrapy_object_to_solr(minio_client, bucket_name, obj.object_name, content_ids,
+                                                       writer),
+                objects, SYNC_SCRAPY_WORKERS):
+            if err is not None:
+                # leave the file in the bucket, it will be picked up by the next run
+                logger.error("Failed to sync %s: %s", obj.object_name, err)
+                failed.append(obj.object_name)
+                run.errors += 1
+            else:
+                run.documents_in += sum(result)
+                run.documents_out += sum(result)
 
-            logger.info("Found " + str(updated_items) + " updated items")
-            logger.info("Found " + str(new_items) + " new items")
+        # Update solr index
+        writer.commit()
+        if failed:
+            run.error_message = "Failed to sync " + ", ".join(failed)
 
-            # Update solr index one last time
-            client.add(results, commit=True)
+    # raised after the run is recorded, so the synced files are committed and the task still fails
+    if failed:
+        raise RuntimeError("Failed to sync %d files from %s: %s" % (len(failed), bucket_name, ", ".join(failed)))
 
-            # move jsonlines file to archive
-            logger.info("ALL good, MOVE to '%s'", bucket_archive_name)
-            minio_client.copy_object(
-                bucket_archive_name, obj.object_name, bucket_name + "/" + obj.object_name)
-            minio_client.remove_object(bucket_name, obj.object_name)
 
-    except ResponseError as err:
-        raise
+def sync_scrapy_object_to_solr(minio_client, bucket_name, object_name, content_ids, writer):
+    bucket_archive_name = bucket_name + "-archive"
+    # Fetch jsonlines file
+    logger.info("Working on %s", object_name)
+    file_data = minio_client.get_object(bucket_name, object_name)
+    updated_items = 0
+    new_items = 0
+    changed_content_ids = []
+    try:
+        # stream the file line by line instead of loading it in memory
+        with jsonlines.Reader(file_data) as reader:
+            for json in reader:
+                if json['id'] in content_ids:
+                    updated_items = updated_items + 1
+                    if any(field in json for field in SCRAPY_CONTENT_FIELDS):
+                        changed_content_ids.append(json['id'])
+                    writer.add(rewrite_json_doc_to_update(json))
+                else:
+                    new_items = new_items + 1
+                    writer.add(json)
+    finally:
+        file_data.close()
+        file_data.release_conn()
+
+    logger.info("Found " + str(updated_items) + " updated items in " + object_name)
+    logger.info("Found " + str(new_items) + " new items in " + object_name)
+
+    # only archive the file once its documents have been sent to solr
+    writer.flush()
+    # documents with new content are parsed and extracted again
+    try:
+        reset_documents(changed_content_ids, CONTENT_STAGES)
+    finally:
+        # this runs in a worker thread of sync_scrapy_to_solr_task, close the database connection it opened
+        connection.close()
+
+    # move jsonlines file to archive
+    logger.info("ALL good, MOVE to '%s'", bucket_archive_name)
+    minio_client.copy_object(
+        bucket_archive_name, object_name, bucket_name + "/" + object_name)
+    minio_client.remove_object(bucket_name, object_name)
+    return updated_items, new_items
 
 
 def rewrite_json_doc_to_update(doc):
@@ -641,21 +740,29 @@ def rewrite_json_doc_to_update(doc):
 
 
 @shared_task
-def check_documents_unvalidated_task(website_id):
+def check_documents_unvalidated_task(website_id, since=None, run_id=None):
+    """
+    Recompute Document.unvalidated for a website with a single UPDATE.
+    A document is unvalidated when none of its acceptance states has another value than UNVALIDATED.
+    When since (ISO 8601 datetime) is given, only documents with acceptance states created or updated
+    after it, and validated documents whose validated states were deleted, are touched.
+    Returns the watermark to pass as since on the next incremental run.
+    """
     website = Website.objects.get(pk=website_id)
+    watermark = timezone.now()
     logger.info(
         "Set unvalidated field for all documents for website: %s", str(website))
     docs = Document.objects.filter(website=website)
-    for doc in docs:
-        # get all acceptance states that are not unvalidated
-        validated_states = AcceptanceState.objects.filter(document=doc).exclude(
-            value=AcceptanceStateValue.UNVALIDATED)
-        # update document unvalidated state accordingly
-        if not validated_states:
-            doc.unvalidated = True
-        else:
-            doc.unvalidated = False
-        doc.save()
+    if since:
+        changed_states = AcceptanceState.objects.filter(updated_at__gte=parse_datetime(since))
+        # a deleted state changes no remaining row
+        docs = docs.filter(Q(pk__in=changed_states.values('document_id')) |
+                           Q(pk__in=stale_validated_documents(docs).values('pk')))
+    with pipeline_stage(website_id, 'check_documents_unvalidated', run_id) as run:
+        count = update_documents_unvalidated(docs)
+        run.documents_in = run.documents_out = count
+    logger.info("Updated unvalidated field for %s documents", count)
+    return watermark.isoformat()
 
 
 def create_bucket(client, name):
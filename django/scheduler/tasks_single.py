@@ -3,23 +3,22 @@ import logging
 import os
 from io import BytesIO
 
-import pysolr
-import requests
 from celery import shared_task, chain
 from django.core.serializers import serialize
-from minio import Minio, ResponseError
+from minio import ResponseError
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists
-from tika import parser
 
 from scheduler.extract import extract_terms_for_document, fetch_typesystem
+from scheduler.parsing import parse_media_file, create_plaintext_cache_bucket
+from searchapp.clients import get_minio, get_solr_session
 from searchapp.datahandling import classify
 from searchapp.models import Website, Document, AcceptanceState, AcceptanceStateValue
+from searchapp.solr_call import solr_get
+from searchapp.solr_writer import SolrWriter, SOLR_COMMIT_WITHIN
 
 logger = logging.getLogger(__name__)
 workpath = os.path.dirname(os.path.abspath(__file__))
 
-CONST_UPDATE_WITH_COMMIT = "/update?commit=true"
-
 
 @shared_task
 def full_service_single(document_id):
@@ -27,6 +26,7 @@ def full_service_single(document_id):
         minio_upload.s(document_id),
         solr_upload.si(document_id),
         parse_content_to_plaintext.si(document_id),
+        # the tasks below get the document id and read the content from Solr
         score_document.s(),
         extract_terms_for_document.s()
     )()
@@ -37,8 +37,7 @@ def minio_upload(document_id):
     document_json = document_to_json(document_id)
     website = Website.objects.get(pk=document_json['website'])
     document_json['website'] = website.name.lower()
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+    minio_client = get_minio()
     bucket_name = website.name.lower()
     bucket_archive_name = bucket_name + "-archive"
     bucket_failed_name = bucket_name + "-failed"
@@ -76,8 +75,7 @@ def solr_upload(document_id):
     website = Website.objects.get(pk=document_json['website'])
     document_json['website'] = website.name.lower()
     bucket_name = document_json['website']
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+    minio_client = get_minio()
     bucket_archive_name = bucket_name + "-archive"
     bucket_failed_name = bucket_name + "-failed"
     create_bucket(minio_client, bucket_archive_name)
@@ -90,7 +88,7 @@ def solr_upload(document_id):
     output = BytesIO()
     for d in file_data.stream(32 * 1024):
         output.write(d)
-    r = requests.post(url, output.getvalue())
+    r = get_solr_session().post(url, output.getvalue(), params={'commitWithin': SOLR_COMMIT_WITHIN})
     json_r = r.json()
     logger.info("SOLR RESPONSE: %s", json_r)
     if json_r['responseHeader']['status'] == 0:
@@ -101,36 +99,20 @@ def solr_upload(document_id):
         minio_client.copy_object(bucket_failed_name, file_name, bucket_name + "/" + file_name)
 
     minio_client.remove_object(bucket_name, file_name)
-    # Update solr index
-    requests.get(os.environ['SOLR_URL'] + '/' +
-                 core + CONST_UPDATE_WITH_COMMIT)
     return document_id
 
 
 @shared_task
 def parse_content_to_plaintext(document_id):
     document_json = document_to_json(document_id)
-    # Make sure solr index is updated
-    core = 'documents'
-    requests.get(os.environ['SOLR_URL'] +
-                 '/' + core + CONST_UPDATE_WITH_COMMIT)
-
-    minio_client = Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
-                         secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
-    solr_client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    minio_client = get_minio()
+    create_plaintext_cache_bucket(minio_client)
 
     # Parse content
     content_text = None
     if 'file' in document_json:
         try:
-            file_data = minio_client.get_object(
-                os.environ['MINIO_STORAGE_MEDIA_BUCKET_NAME'], document_json['file'])
-            output = BytesIO()
-            for d in file_data.stream(32 * 1024):
-                output.write(d)
-            content_text = parser.from_buffer(output.getvalue())
-            if 'content' in content_text:
-                content_text = content_text['content']
+            content_text = parse_media_file(minio_client, document_json['file'], document_json['id'])
         except ResponseError as err:
             print(err)
 
@@ -143,25 +125,30 @@ def parse_content_to_plaintext(document_id):
         logger.debug('Got content for: %s (%s)',
                      document_json['id'], len(content_text))
         # add to document model and save
-        document = {"id": document_json['id'],
-                    "content": {"set": content_text}}
-        document_json['content'] = content_text
         logger.info("Post to solr")
-        solr_client.add(document)
-        requests.get(os.environ['SOLR_URL'] +
-                     '/' + core + CONST_UPDATE_WITH_COMMIT)
-    return document_json
+        with SolrWriter('documents') as writer:
+            writer.set_fields(document_json['id'], content=content_text)
+    return document_json['id']
 
 
 @shared_task
-def score_document(document_json):
+def score_document(document_id):
     CLASSIFIER_ERROR_SCORE = -9999
     DJANGO_ERROR_SCORE = -1
     ACCEPTED_THRESHOLD = 0.5
-    core = 'documents'
-    solr_client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    classifier_response = classify(document_json['id'], document_json['content'], 'pdf')
-    accepted_probability = classifier_response["accepted_probability"]
+    if isinstance(document_id, dict):
+        # document json from before tasks were sent ids only
+        document_id = document_id['id']
+    # real-time get, the content written by parse_content_to_plaintext isn't committed yet
+    solr_doc = solr_get('documents', document_id, fl='id,content') or {}
+    content = solr_doc.get('content') or ''
+    if isinstance(content, list):
+        content = content[0]
+    if content:
+        classifier_response = classify(document_id, content, 'pdf')
+        accepted_probability = classifier_response["accepted_probability"]
+    else:
+        accepted_probability = CLASSIFIER_ERROR_SCORE
     # Check acceptance
     if accepted_probability != CLASSIFIER_ERROR_SCORE:
         # Validated
@@ -172,12 +159,9 @@ def score_document(document_json):
         classifier_status = AcceptanceStateValue.UNVALIDATED
 
     # Storage
-    django_doc = Document.objects.get(pk=document_json["id"])
+    django_doc = Document.objects.get(pk=document_id)
     django_doc.acceptance_state_max_probability = accepted_probability
     django_doc.save()
-    score_update = {"id": document_json["id"],
-                    "accepted_probability": {"set": accepted_probability},
-                    "acceptance_state": {"set": classifier_status}}
     # Store AcceptanceState
     AcceptanceState.objects.update_or_create(
         probability_model="auto classifier",
@@ -191,9 +175,8 @@ def score_document(document_json):
 
     # Store score in solr
     logger.info("Posting score to SOLR")
-    solr_client.add(score_update)
-    requests.get(os.environ['SOLR_URL'] + '/' + core + '/update?commit=true')
+    with SolrWriter('documents') as writer:
+        writer.set_fields(document_id, accepted_probability=accepted_probability,
+                          acceptance_state=classifier_status)
 
-    # store document content in array, so it mimics a solr document
-    document_json['content'] = [document_json['content']]
-    return document_json
+    return document_id
@@ -2,7 +2,16 @@ from django.test import TestCase
 
 from cassis.typesystem import load_typesystem
 from cassis.xmi import load_cas_from_xmi
-from unittest import skip
+from unittest import skip, mock
+from collections import namedtuple
+import uuid
+
+import pysolr
+
+from scheduler import extract
+from scheduler.cas_index import AnnotationIndex
+from scheduler.chunking import split_html_paragraphs
+from searchapp.models import Website, PipelineRun
 
 # Create your tests here.
 class ExtractTerms(TestCase):
@@ -58,3 +67,64 @@ class ExtractTerms(TestCase):
 
         self.assertEqual(num_defi, 39)
 
+
+
+class AnnotationIndexTest(TestCase):
+
+    def test_matches_linear_scan(self):
+        """
+        check if the index returns the same annotations as scanning all of them
+        """
+        Annotation = namedtuple("Annotation", ["begin", "end"])
+        annotations = [Annotation(begin, begin + length) for begin in range(0, 60, 3) for length in (0, 2, 7, 25)]
+        index = AnnotationIndex(reversed(annotations))
+        for query in annotations + [Annotation(1, 4), Annotation(50, 90)]:
+            self.assertEqual(index.covering(query), sorted(
+                a for a in annotations if a.begin <= query.begin and a.end >= query.end))
+            self.assertEqual(index.covered(query), sorted(
+                a for a in annotations if a.begin >= query.begin and a.end <= query.end))
+            self.assertEqual(index.exact(query), [a for a in annotations if a == query])
+
+
+class SplitHtmlParagraphsTest(TestCase):
+
+    def test_split_on_paragraphs(self):
+        """
+        check if html is split on paragraph ends without losing content
+        """
+        html = "<body>" + "".join("<p>paragraph %d</p>" % i for i in range(100)) + "</body>"
+        chunks = split_html_paragraphs(html, 200)
+        self.assertEqual("".join(chunks), html)
+        self.assertTrue(all(len(chunk) <= 200 for chunk in chunks))
+        self.assertTrue(all(chunk.endswith("</p>") for chunk in chunks[:-1]))
+        self.assertEqual(split_html_paragraphs(html, len(html)), [html])
+
+
+class FanOutBatchTest(TestCase):
+
+    def test_failed_solr_flush_does_not_finish_run(self):
+        """
+        check if a batch whose Solr updates are lost counts its documents once, as errors
+        """
+        website = Website.objects.create(name="test", url="http://test.example")
+        # dispatched in two batches of two documents
+        run = PipelineRun.objects.create(website=website, stage="extract_terms", documents_in=4)
+        batch = [str(uuid.uuid4()), str(uuid.uuid4())]
+
+        def run_nlp_pipeline(documents, fetch, process):
+            for document in documents:
+                process(document, None)
+            return len(documents), 0, []
+
+        with mock.patch.object(extract, "run_nlp_pipeline", run_nlp_pipeline), \
+                mock.patch.object(extract, "process_terms_cas"), \
+                mock.patch.object(extract, "SolrWriter") as solr_writer:
+            solr_writer.return_value.close.side_effect = pysolr.SolrError("flush failed")
+            result = extract.extract_terms_for_documents(batch, website.pk, run.pk)
+
+        self.assertEqual(result["processed"], 0)
+        self.assertEqual(sorted(result["failed"]), sorted(batch))
+        run.refresh_from_db()
+        self.assertEqual(run.documents_out, 0)
+        self.assertEqual(run.errors, 2)
+        self.assertIsNone(run.finished_at)
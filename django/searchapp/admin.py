@@ -1,16 +1,20 @@
 import logging
 import os
 
-import requests
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.db.models import OuterRef, Subquery
+from django.urls import reverse
+from django.utils.html import format_html
 
 from admin_rest.models import site as rest_site
 from scheduler import tasks
 from scheduler.tasks import full_service_task, sync_documents_task, scrape_website_task, \
     parse_content_to_plaintext_task, sync_scrapy_to_solr_task, check_documents_unvalidated_task
 from scheduler.extract import send_document_to_webanno
-from .models import Website, Attachment, Document, AcceptanceState, Comment, Tag
+from .clients import get_solr_session
+from .models import Website, Attachment, Document, AcceptanceState, Comment, Tag, PipelineRun, \
+    DocumentProcessingState
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +29,7 @@ rest_site.register(Attachment)
 rest_site.register(AcceptanceState)
 rest_site.register(Comment)
 rest_site.register(Tag)
+rest_site.register(PipelineRun)
 rest_site.register(User)
 
 
@@ -98,7 +103,7 @@ def handle_document_updates(modeladmin, request, queryset):
 
 def delete_from_solr(modeladmin, request, queryset):
     for website in queryset:
-        r = requests.post(os.environ['SOLR_URL'] + '/' +
+        r = get_solr_session().post(os.environ['SOLR_URL'] + '/' +
                           'documents' + '/update?commit=true', headers={'Content-Type': 'application/json'},
                           data='{"delete": {"query": "website:' + website.name.lower() + '"}}')
         logger.info("Deleted solr content for website: %s => %s",
@@ -125,7 +130,7 @@ def export_websites_from_rdf(modeladmin, request, queryset):
 
 
 class WebsiteAdmin(admin.ModelAdmin):
-    list_display = ['name', 'count_documents']
+    list_display = ['name', 'count_documents', 'last_pipeline_run']
     ordering = ['name']
     actions = [full_service, scrape_website, handle_document_updates, sync_scrapy_to_solr, parse_content_to_plaintext,
                sync_documents, delete_documents_not_in_solr, score_documents, check_documents_unvalidated,
@@ -138,6 +143,38 @@ class WebsiteAdmin(admin.ModelAdmin):
 
     count_documents.short_description = "Documents"
 
+    def get_queryset(self, request):
+        # the last pipeline run of every website is fetched with the changelist query
+        last_runs = PipelineRun.objects.filter(website=OuterRef('pk')).order_by('-started_at')
+        return super().get_queryset(request).annotate(
+            last_run_id=Subquery(last_runs.values('run_id')[:1]),
+            last_run_started_at=Subquery(last_runs.values('started_at')[:1]),
+            last_run_stage=Subquery(last_runs.values('stage')[:1]),
+        )
+
+    def last_pipeline_run(self, website):
+        if website.last_run_id is None:
+            return "-"
+        url = reverse('admin:searchapp_pipelinerun_changelist') + '?run_id=' + str(website.last_run_id)
+        return format_html('<a href="{}">{} ({})</a>', url, website.last_run_started_at.strftime("%Y-%m-%d %H:%M"),
+                           website.last_run_stage)
+
+    last_pipeline_run.short_description = "Last pipeline run"
+
+
+class PipelineRunAdmin(admin.ModelAdmin):
+    list_display = ['website', 'stage', 'started_at', 'finished_at', 'duration', 'documents_in', 'documents_out',
+                    'throughput', 'errors', 'run_id']
+    list_filter = ('website__name', 'stage')
+    search_fields = ['run_id', 'task_id']
+    readonly_fields = ['duration', 'throughput']
+
+
+class DocumentProcessingStateAdmin(admin.ModelAdmin):
+    list_display = ['document_id', 'website', 'stage', 'status', 'version', 'attempts', 'started_at', 'finished_at']
+    list_filter = ('website__name', 'stage', 'status')
+    search_fields = ['document_id', 'error']
+
 
 def extract_terms_document(modeladmin, request, queryset):
     for document in queryset:
@@ -162,5 +199,7 @@ class DocumentAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Website, WebsiteAdmin)
+admin.site.register(PipelineRun, PipelineRunAdmin)
+admin.site.register(DocumentProcessingState, DocumentProcessingStateAdmin)
 
 admin.site.register(Document, DocumentAdmin)
@@ -0,0 +1,92 @@
+import os
+import threading
+
+import pysolr
+import requests
+import urllib3
+from minio import Minio
+from requests.adapters import HTTPAdapter
+
+# connections kept open per HTTP service
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# seconds to wait for an HTTP service (NLP, classifier, Fuseki, ...) to answer
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 300))
+SOLR_TIMEOUT = int(os.environ.get('SOLR_TIMEOUT', 60))
+MINIO_POOL_SIZE = int(os.environ.get('MINIO_POOL_SIZE', 10))
+MINIO_CONNECT_TIMEOUT = float(os.environ.get('MINIO_CONNECT_TIMEOUT', 10))
+MINIO_READ_TIMEOUT = float(os.environ.get('MINIO_READ_TIMEOUT', 300))
+
+_clients = {}
+_clients_pid = None
+_lock = threading.RLock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests Session with a default timeout for every request.
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def _get_client(key, factory):
+    """
+    Clients are created once per process and shared by all tasks, views and threads in it.
+    Celery and gunicorn fork their workers, so a child never reuses the connections of its parent.
+    """
+    global _clients_pid
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = factory()
+        return client
+
+
+def get_http_session(name='default', pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+    """
+    Pooled keep-alive session for the HTTP service called name.
+    pool_size and timeout are only used when the session is created.
+    """
+    def create():
+        session = TimeoutSession(timeout)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    return _get_client(('http', name), create)
+
+
+def get_solr(core):
+    def create():
+        client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core, timeout=SOLR_TIMEOUT)
+        client.session = get_solr_session()
+        return client
+
+    return _get_client(('solr', core), create)
+
+
+def get_solr_session():
+    return get_http_session('solr', timeout=SOLR_TIMEOUT)
+
+
+def get_minio():
+    def create():
+        http_client = urllib3.PoolManager(
+            maxsize=MINIO_POOL_SIZE,
+            timeout=urllib3.Timeout(connect=MINIO_CONNECT_TIMEOUT, read=MINIO_READ_TIMEOUT),
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+        )
+        return Minio(os.environ['MINIO_STORAGE_ENDPOINT'], access_key=os.environ['MINIO_ACCESS_KEY'],
+                     secret_key=os.environ['MINIO_SECRET_KEY'], secure=False, http_client=http_client)
+
+    return _get_client(('minio',), create)
@@ -1,115 +1,233 @@
 import base64
+import hashlib
 import json
 import logging
 import os
 
-import pysolr
-import requests
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
 
+from scheduler.pool import imap_bounded
+from scheduler.processing_state import mark_done, mark_failed, STAGE_SCORE
+from searchapp.clients import get_http_session
 from searchapp.models import Document, Website, AcceptanceState, AcceptanceStateValue
+from searchapp.solr_writer import SolrWriter
 
 logger = logging.getLogger(__name__)
 workpath = os.path.dirname(os.path.abspath(__file__))
 
+# if the classifier returns this value as either accepted or rejected
+# probability, it means something went wrong decoding the content
+CLASSIFIER_ERROR_SCORE = -9999
+DJANGO_ERROR_SCORE = -1
+ACCEPTED_THRESHOLD = 0.5
+AUTO_CLASSIFIER = "auto classifier"
+# number of classifier requests in flight
+CLASSIFIER_WORKERS = int(os.environ.get('CLASSIFIER_WORKERS', 8))
+CLASSIFIER_TIMEOUT = int(os.environ.get('CLASSIFIER_TIMEOUT', 300))
+# bump when the classifier model changes so all documents are scored again
+CLASSIFIER_MODEL_VERSION = os.environ.get('DOCUMENT_CLASSIFIER_VERSION', '1')
+# number of documents scored and persisted together
+SCORE_BATCH_SIZE = 500
+
+
+def get_classifier_session():
+    return get_http_session('classifier', pool_size=CLASSIFIER_WORKERS, timeout=CLASSIFIER_TIMEOUT)
+
 
 def score_documents(website_name, solr_documents):
-    # if the classifier returns this value as either accepted or rejected
-    # probability, it means something went wrong decoding the content
-    CLASSIFIER_ERROR_SCORE = -9999
-    DJANGO_ERROR_SCORE = -1
-    ACCEPTED_THRESHOLD = 0.5
-    score_updates = []
-    content_updates = []
-    core = 'documents'
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    """
+    Score the solr documents and store the results in django and solr.
+    Returns the number of documents read, scored and the number of documents that failed to score,
+    a document that failed isn't counted as scored.
+    """
+    website = Website.objects.get(name=website_name)
+    writer = SolrWriter('documents')
+    total = 0
+    scored = 0
+    skipped = 0
+    errors = 0
     # loop documents
+    batch = []
     for solr_doc in solr_documents:
-        content = ''
-        accepted_probability = CLASSIFIER_ERROR_SCORE
-        accepted_probability_index = 0
+        total += 1
+        batch.append(solr_doc)
+        if len(batch) == SCORE_BATCH_SIZE:
+            batch_updates, batch_skipped, batch_errors = score_batch(batch)
+            # Store scores in solr
+            writer.add(batch_updates)
+            record_score_states(website.id, batch_updates)
+            scored += len(batch_updates) - batch_errors
+            skipped += batch_skipped
+            errors += batch_errors
+            batch = []
+    batch_updates, batch_skipped, batch_errors = score_batch(batch)
+    writer.add(batch_updates)
+    record_score_states(website.id, batch_updates)
+    scored += len(batch_updates) - batch_errors
+    skipped += batch_skipped
+    errors += batch_errors
+    logger.info("Skipped %d documents with unchanged content and classifier version", skipped)
 
-        if solr_doc.get('content'):
-            # classifier uses base64 content
-            content = solr_doc['content'][0]
-            classifier_response = classify(
-                str(solr_doc["id"]), content, solr_doc["language"])
-            accepted_probability = classifier_response["accepted_probability"]
+    # Add unvalidated state for documents without AcceptanceState
+    # This can happen when documents didn't have content or couldn't calculate a score
+    logger.info("Handling documents without AcceptanceState...")
+    docs = Document.objects.filter(Q(website=website) & Q(
+        acceptance_state_max_probability__isnull=True))
+    doc_ids = list(docs.values_list('id', flat=True))
+    with transaction.atomic():
+        AcceptanceState.objects.filter(document_id__in=doc_ids, probability_model=AUTO_CLASSIFIER).update(
+            value=AcceptanceStateValue.UNVALIDATED,
+            accepted_probability=DJANGO_ERROR_SCORE,
+            accepted_probability_index=0,
+            updated_at=timezone.now()
+        )
+        scored_ids = set(AcceptanceState.objects.filter(document_id__in=doc_ids, probability_model=AUTO_CLASSIFIER)
+                         .values_list('document_id', flat=True))
+        AcceptanceState.objects.bulk_create([
+            AcceptanceState(document_id=doc_id, probability_model=AUTO_CLASSIFIER,
+                            value=AcceptanceStateValue.UNVALIDATED, accepted_probability=DJANGO_ERROR_SCORE,
+                            accepted_probability_index=0)
+            for doc_id in doc_ids if doc_id not in scored_ids
+        ], batch_size=SCORE_BATCH_SIZE)
+        Document.objects.filter(pk__in=doc_ids).update(acceptance_state_max_probability=DJANGO_ERROR_SCORE)
+        update_documents_unvalidated(Document.objects.filter(pk__in=doc_ids))
+    logger.info("Created unvalidated state for %d documents", len(doc_ids))
+
+    # Flush last updates and update solr index
+    logger.info("Committing SOLR index...")
+    writer.commit()
+    return total, scored, errors
+
+
+def score_batch(solr_docs):
+    """
+    Score a batch of Solr documents with several classifier requests in flight and persist the results
+    with bulk queries. Documents whose content and classifier version didn't change since they were
+    last scored are skipped. Returns the Solr score updates, the number of skipped and failed documents.
+    Documents without content or for which the classifier failed are failed, their updates are included.
+    """
+    if not solr_docs:
+        return [], 0, 0
+    doc_ids = set(str(doc_id) for doc_id in
+                  Document.objects.filter(pk__in=[solr_doc["id"] for solr_doc in solr_docs])
+                  .values_list('id', flat=True))
+    states = {str(state.document_id): state for state in
+              AcceptanceState.objects.filter(document_id__in=doc_ids, probability_model=AUTO_CLASSIFIER)}
 
+    to_score = []
+    for solr_doc in solr_docs:
+        if solr_doc["id"] not in doc_ids:
+            logger.warning("Document %s is not synced to django, not scoring", solr_doc["id"])
+            continue
+        content = solr_doc['content'][0] if solr_doc.get('content') else ''
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        state = states.get(solr_doc["id"])
+        if state is not None and state.content_hash == content_hash and \
+                state.model_version == CLASSIFIER_MODEL_VERSION:
+            continue
+        to_score.append((solr_doc, content, content_hash))
+
+    results = []
+    for (solr_doc, content, content_hash), accepted_probability, err in imap_bounded(
+            lambda item: score_content(item[0], item[1]), to_score, CLASSIFIER_WORKERS):
+        if err is not None:
+            logger.error("Failed to score document %s: %s", solr_doc["id"], err)
+            accepted_probability = CLASSIFIER_ERROR_SCORE
+        results.append((solr_doc["id"], content_hash, accepted_probability))
+
+    score_updates = []
+    documents = []
+    to_create = []
+    to_update = []
+    errors = 0
+    now = timezone.now()
+    for doc_id, content_hash, accepted_probability in results:
         # Check acceptance
         if accepted_probability != CLASSIFIER_ERROR_SCORE:
             # Validated
             classifier_status = AcceptanceStateValue.ACCEPTED if accepted_probability > ACCEPTED_THRESHOLD else AcceptanceStateValue.REJECTED
         else:
-            # couldn't classify
+            # couldn't classify, don't record the hash so the document is scored again on the next run
             accepted_probability = DJANGO_ERROR_SCORE
             classifier_status = AcceptanceStateValue.UNVALIDATED
+            content_hash = None
+            errors += 1
 
-        # Storage
-        django_doc = Document.objects.get(pk=solr_doc["id"])
-        django_doc.acceptance_state_max_probability = accepted_probability
-        django_doc.save()
-        score_updates.append({"id": solr_doc["id"],
+        documents.append(Document(id=doc_id, acceptance_state_max_probability=accepted_probability))
+        score_updates.append({"id": doc_id,
                               "accepted_probability": {"set": accepted_probability},
                               "acceptance_state": {"set": classifier_status}})
-        # Store AcceptanceState
-        AcceptanceState.objects.update_or_create(
-            probability_model="auto classifier",
-            document=django_doc,
-            defaults={
-                'value': classifier_status,
-                'accepted_probability': accepted_probability,
-                'accepted_probability_index': accepted_probability_index
-            }
-        )
+        state = states.get(doc_id)
+        if state is None:
+            state = AcceptanceState(document_id=doc_id, probability_model=AUTO_CLASSIFIER)
+            to_create.append(state)
+        else:
+            state.updated_at = now
+            to_update.append(state)
+        state.value = classifier_status
+        state.accepted_probability = accepted_probability
+        state.accepted_probability_index = 0
+        state.content_hash = content_hash
+        state.model_version = CLASSIFIER_MODEL_VERSION if content_hash is not None else None
 
-        # Store scores (and content) in solr
-        if len(score_updates) == 1000:
-            logger.info("Posting %d scores to SOLR", len(score_updates))
-            client.add(score_updates)
-            score_updates = []
-            requests.get(os.environ['SOLR_URL'] +
-                         '/' + core + '/update?commit=true')
-
-        if len(content_updates) == 10:
-            logger.info("Posting %d content to SOLR", len(content_updates))
-            client.add(content_updates)
-            content_updates = []
-            requests.get(os.environ['SOLR_URL'] +
-                         '/' + core + '/update?commit=true')
+    # Storage
+    with transaction.atomic():
+        Document.objects.bulk_update(documents, ['acceptance_state_max_probability'])
+        AcceptanceState.objects.bulk_create(to_create)
+        AcceptanceState.objects.bulk_update(to_update, ['value', 'accepted_probability', 'accepted_probability_index',
+                                                        'content_hash', 'model_version', 'updated_at'])
+        update_documents_unvalidated(Document.objects.filter(pk__in=[doc.id for doc in documents]))
 
-    # Add unvalidated state for documents without AcceptanceState
-    # This can happen when documents didn't have content or couldn't calculate a score
-    logger.info("Handling documents without AcceptanceState...")
-    website = Website.objects.get(name=website_name)
-    docs = Document.objects.filter(Q(website=website) & Q(
-        acceptance_state_max_probability__isnull=True))
-    for doc in docs:
-        logger.info("CREATE: %s", doc.id)
-        AcceptanceState.objects.update_or_create(
-            probability_model="auto classifier",
-            document=doc,
-            defaults={
-                'value': AcceptanceStateValue.UNVALIDATED,
-                'accepted_probability': DJANGO_ERROR_SCORE,
-                'accepted_probability_index': 0
-            }
-        )
-        doc.acceptance_state_max_probability = DJANGO_ERROR_SCORE
-        doc.save()
+    return score_updates, len(solr_docs) - len(to_score), errors
 
-    # Flush last updates
-    client.add(score_updates)
-    client.add(content_updates)
-    # Update solr index
-    logger.info("Committing SOLR index...")
-    core = 'documents'
-    requests.get(os.environ['SOLR_URL'] + '/' + core + '/update?commit=true')
+
+def record_score_states(website_id, score_updates):
+    """
+    Record the scored documents in DocumentProcessingState, documents that couldn't be scored as failed.
+    """
+    failed_ids = [update["id"] for update in score_updates
+                  if update["accepted_probability"]["set"] == DJANGO_ERROR_SCORE]
+    done_ids = [update["id"] for update in score_updates
+                if update["accepted_probability"]["set"] != DJANGO_ERROR_SCORE]
+    mark_done(website_id, done_ids, STAGE_SCORE, CLASSIFIER_MODEL_VERSION)
+    mark_failed(website_id, failed_ids, STAGE_SCORE, CLASSIFIER_MODEL_VERSION, "no content or classifier error")
+
+
+def score_content(solr_doc, content):
+    if not content:
+        return CLASSIFIER_ERROR_SCORE
+    # classifier uses base64 content
+    classifier_response = classify(
+        str(solr_doc["id"]), content, solr_doc.get("language"))
+    return classifier_response["accepted_probability"]
+
+
+def validated_states():
+    # the acceptance states of the outer document with another value than UNVALIDATED
+    return AcceptanceState.objects.filter(document=OuterRef('pk')).exclude(value=AcceptanceStateValue.UNVALIDATED)
+
+
+def update_documents_unvalidated(docs):
+    """
+    Set Document.unvalidated for all documents in the docs queryset with a single UPDATE:
+    a document is unvalidated when none of its acceptance states has another value than UNVALIDATED.
+    """
+    return docs.update(unvalidated=~Exists(validated_states()))
+
+
+def stale_validated_documents(docs):
+    """
+    The documents in docs marked as validated that have no validated acceptance state left,
+    e.g. because it was deleted.
+    """
+    return docs.filter(unvalidated=False).annotate(has_validated_state=Exists(validated_states())).filter(
+        has_validated_state=False)
 
 
 def classify(django_doc_id, content, language):
     classifier_url = os.environ['DOCUMENT_CLASSIFIER_URL'] + "/classify_doc"
-    CLASSIFIER_ERROR_SCORE = -9999
     max_content_size_bytes = 50 * 1024 * 1024
     content_bytes = bytes(content, 'utf-8')
     # don't classify if content > max_content_size_bytes
@@ -119,7 +237,7 @@ def classify(django_doc_id, content, language):
         data = {'content': content_html_b64,
                 'language': language}
         logger.debug("Sending content for doc id: " + django_doc_id)
-        response = requests.post(classifier_url, json=data)
+        response = get_classifier_session().post(classifier_url, json=data)
         js = response.json()
         js['content'] = content
         logger.debug("Got classifier response: " + json.dumps(js))
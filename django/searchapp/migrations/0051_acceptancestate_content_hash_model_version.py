@@ -0,0 +1,23 @@
+# Generated by Django 3.0.9 on 2021-02-24 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0050_auto_20210126_1136'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='acceptancestate',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='acceptancestate',
+            name='model_version',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.0.9 on 2021-02-25 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0051_acceptancestate_content_hash_model_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.UUIDField(db_index=True, default=uuid.uuid4)),
+                ('stage', models.CharField(db_index=True, max_length=100)),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('documents_in', models.IntegerField(default=0)),
+                ('documents_out', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('website', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pipeline_runs', to='searchapp.Website')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
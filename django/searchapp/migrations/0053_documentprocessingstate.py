@@ -0,0 +1,38 @@
+# Generated by Django 3.0.9 on 2021-03-01 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0052_pipelinerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentProcessingState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_id', models.UUIDField()),
+                ('stage', models.CharField(max_length=100)),
+                ('status', models.CharField(choices=[('Pending', 'Pending'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')], db_index=True, default='Pending', max_length=20)),
+                ('version', models.CharField(blank=True, max_length=50, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('website', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='processing_states', to='searchapp.Website')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='documentprocessingstate',
+            index=models.Index(fields=['website', 'stage', 'status'], name='searchapp_d_website_d63d4b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='documentprocessingstate',
+            constraint=models.UniqueConstraint(fields=('document_id', 'stage'), name='unique_per_doc_and_stage'),
+        ),
+    ]
@@ -1,7 +1,5 @@
-import os
 import uuid
 
-import pysolr
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
@@ -9,6 +7,7 @@ from django.db.models import Q
 from django.contrib.auth.models import User
 
 from searchapp.solr_call import solr_update
+from searchapp.solr_writer import SolrWriter
 
 
 class Website(models.Model):
@@ -79,12 +78,8 @@ class Document(models.Model):
         solr_update("documents", solr_doc)
 
     def update_score(self, score, status):
-        core = 'documents'
-        client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-        document = {"id": str(self.id),
-                    "accepted_probability": {"set": score},
-                    "acceptance_state": {"set": status}}
-        client.add(document)
+        with SolrWriter('documents') as writer:
+            writer.set_fields(self.id, accepted_probability=score, acceptance_state=status)
 
 
 class AcceptanceStateValue(models.TextChoices):
@@ -105,6 +100,9 @@ class AcceptanceState(models.Model):
         max_length=50, blank=True, null=True, db_index=True)
     accepted_probability = models.FloatField(default=0.0, blank=True)
     accepted_probability_index = models.IntegerField(default=0, blank=True)
+    # SHA-256 of the scored content and classifier version, used to skip rescoring unchanged documents
+    content_hash = models.CharField(max_length=64, blank=True, null=True)
+    model_version = models.CharField(max_length=50, blank=True, null=True)
 
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
@@ -195,3 +193,77 @@ class Bookmark(models.Model):
 
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+
+
+class PipelineRun(models.Model):
+    # all stages of one full service run share the same run_id
+    run_id = models.UUIDField(default=uuid.uuid4, db_index=True)
+    website = models.ForeignKey(
+        'Website', related_name='pipeline_runs', on_delete=models.CASCADE)
+    stage = models.CharField(max_length=100, db_index=True)
+    task_id = models.CharField(max_length=255, blank=True, null=True)
+
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    documents_in = models.IntegerField(default=0)
+    documents_out = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return self.website.name + " " + self.stage
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def throughput(self):
+        # documents per second
+        if not self.duration:
+            return None
+        return self.documents_out / self.duration
+
+
+class ProcessingStatus(models.TextChoices):
+    PENDING = 'Pending',
+    RUNNING = 'Running',
+    DONE = 'Done',
+    FAILED = 'Failed'
+
+
+class DocumentProcessingState(models.Model):
+    # Solr id of the document, not a foreign key because the first stages run before documents are synced to django
+    document_id = models.UUIDField()
+    website = models.ForeignKey(
+        'Website', related_name='processing_states', on_delete=models.CASCADE, null=True, blank=True)
+    stage = models.CharField(max_length=100)
+    status = models.CharField(max_length=20,
+                              choices=ProcessingStatus.choices,
+                              default=ProcessingStatus.PENDING, db_index=True)
+    # version of the service or model that processed the document, a new version makes the document pending
+    version = models.CharField(max_length=50, blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['document_id', 'stage'], name="unique_per_doc_and_stage"),
+        ]
+        indexes = [
+            models.Index(fields=['website', 'stage', 'status']),
+        ]
+
+    def __str__(self):
+        return str(self.document_id) + " " + self.stage + " " + self.status
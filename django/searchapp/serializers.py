@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User, Group
 from rest_framework import serializers
 
-from searchapp.models import Attachment, Document, Website, AcceptanceState, Comment, Tag, Bookmark
+from searchapp.models import Attachment, Document, Website, AcceptanceState, Comment, Tag, Bookmark, PipelineRun
 from glossary.serializers import ConceptDocumentSerializer
 
 import logging
@@ -138,3 +138,12 @@ class BookmarkSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bookmark
         fields = ['document']
+
+
+class PipelineRunSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+    throughput = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = PipelineRun
+        fields = '__all__'
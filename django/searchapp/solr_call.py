@@ -1,11 +1,14 @@
 import os
 
 import pysolr
-import requests
 import textdistance
 import logging as logger
 
-ROW_LIMIT = 250000
+from searchapp.solr_writer import SolrWriter
+from searchapp.clients import get_solr, get_solr_session
+
+# rows fetched per request when paging with cursorMark
+SOLR_PAGE_SIZE = int(os.environ.get('SOLR_PAGE_SIZE', 1000))
 
 QUERY_ID_ASC = 'id asc'
 QUERY_HL_FL = 'hl.fl'
@@ -17,24 +20,21 @@ QUERY_HL_PREFIX = '<span class="highlight">'
 QUERY_HL_SUFFIX = '</span>'
 
 
-def solr_search(core="", term=""):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    search = get_results_highlighted(client.search(term,
-                                                   **{'rows': ROW_LIMIT, 'hl': 'on', QUERY_HL_FL: '*',
-                                                      QUERY_HL_SNIPPETS: 100, QUERY_HL_MAX_CHARS: 1000000,
-                                                      QUERY_HL_PRE: QUERY_HL_PREFIX,
-                                                      QUERY_HL_POST: QUERY_HL_SUFFIX}))
-    return search
+def solr_search(core="", term="", fl=None):
+    options = {'hl': 'on', QUERY_HL_FL: '*',
+               QUERY_HL_SNIPPETS: 100, QUERY_HL_MAX_CHARS: 1000000,
+               QUERY_HL_PRE: QUERY_HL_PREFIX,
+               QUERY_HL_POST: QUERY_HL_SUFFIX}
+    for response in solr_search_pages(core, term, fl=fl, **options):
+        yield from get_results_highlighted(response)
 
 
 def solr_search_ids(core="", term=""):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    search = client.search(term, **{'rows': ROW_LIMIT, 'fl': 'id'})
-    return search
+    return solr_search_cursor(core, term, fl='id')
 
 
 def solr_search_website_paginated(core="", q="", page_number=1, rows_per_page=10):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
@@ -44,7 +44,7 @@ def solr_search_website_paginated(core="", q="", page_number=1, rows_per_page=10
 
 def solr_search_paginated(core="", term="", page_number=1, rows_per_page=10, ids_to_filter_on=None,
                           sort_by=None, sort_direction='asc'):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
@@ -70,7 +70,7 @@ def solr_search_paginated(core="", term="", page_number=1, rows_per_page=10, ids
 
 def solr_search_query_paginated(core="", term="", page_number=1, rows_per_page=10, ids_to_filter_on=None,
                                 sort_by=None, sort_direction='asc'):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
@@ -111,7 +111,7 @@ def solr_search_query_paginated_preanalyzed(core="", term="", page_number=1, row
     
     if sort_by:
         options['sort'] = sort_by + ' ' + sort_direction
-    response = requests.request("POST", url, data=options)
+    response = get_solr_session().request("POST", url, data=options)
     result = response.json()
     search = get_results_highlighted_preanalyzed(result)
     num_found = result['response']['numFound']
@@ -139,7 +139,7 @@ def solr_search_query_with_doc_id_preanalyzed(doc_id, core="", term="", page_num
     
     if sort_by:
         options['sort'] = sort_by + ' ' + sort_direction
-    response = requests.request("POST", url, data = options)
+    response = get_solr_session().request("POST", url, data = options)
     result = response.json()
     num_found = result['response']['numFound']
     return num_found, result
@@ -167,7 +167,7 @@ def solr_get_preanalyzed_for_doc(core="", id="", field="", term="", page_number=
 
     if sort_by:
         options['sort'] = sort_by + ' ' + sort_direction
-    response = requests.request("POST", url, data=options)
+    response = get_solr_session().request("POST", url, data=options)
     fields = ["concept_occurs", "concept_defined"]
 
     result = response.json()
@@ -184,56 +184,80 @@ def solr_get_preanalyzed_for_doc(core="", id="", field="", term="", page_number=
         return highlights[0][0]
 
 
-def solr_search_id(core="", id=""):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    search = get_results(client.search('id:' + id, **{'rows': ROW_LIMIT}))
-    return search
+def solr_search_id(core="", id="", fl=None):
+    return solr_search_cursor(core, 'id:' + id, fl=fl)
+
 
+def solr_get(core="", id="", fl=None):
+    """
+    Real-time get of a single document, also returns updates that are not committed yet.
+    Returns None when the document doesn't exist.
+    """
+    params = {'id': id, 'wt': 'json'}
+    if fl:
+        params['fl'] = fl
+    response = get_solr_session().get(os.environ['SOLR_URL'] + '/' + core + '/get', params=params)
+    response.raise_for_status()
+    return response.json().get('doc')
 
-def solr_search_id_sorted(core="", id=""):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    search = get_results(client.search(
-        'id:' + id, **{'rows': ROW_LIMIT, 'sort': QUERY_ID_ASC}))
-    return search
 
+def solr_search_id_sorted(core="", id="", fl=None):
+    return solr_search_cursor(core, 'id:' + id, fl=fl, sort=QUERY_ID_ASC)
 
-def solr_search_website_with_content(core="", website="", language="", **kwargs):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+
+def solr_search_website_with_content(core="", website="", language="", fl='id,content,language', **kwargs):
     date = kwargs.get('date', None)
-    query = 'website:' + website
+    query = 'website:' + website + ' AND language:' + language
 
     if date:
         query = query + " AND date:[" + date + " TO NOW]"
-    search = client.search(
-        'website:' + website + ' AND language:' + language, **{'rows': 250, 'start': 0, 'cursorMark': "*", 'sort': 'id asc'})
-    return search
+    return solr_search_cursor(core, query, fl=fl, rows=250)
+
+
+SOLR_SYNC_FIELDS = 'id,title,title_prefix,author,misc_author,status,type,date,dates,dates_type,dates_info,date_last_update,url,eli,celex,file_url,website,summary,various,consolidated_versions'
 
 
-def solr_search_website_sorted(core="", website="", **kwargs):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    SOLR_SYNC_FIELDS = 'id,title,title_prefix,author,misc_author,status,type,date,dates,dates_type,dates_info,date_last_update,url,eli,celex,file_url,website,summary,various,consolidated_versions'
+def solr_search_website_sorted(core="", website="", fl=SOLR_SYNC_FIELDS, **kwargs):
     date = kwargs.get('date', None)
     query = 'website:' + website
 
     if date:
         query = query + " AND date:[" + date + " TO NOW]"
-    search = get_results(client.search(
-        query, **{'rows': ROW_LIMIT, 'fl': SOLR_SYNC_FIELDS, 'sort': QUERY_ID_ASC}))
-    return search
-
-
-def solr_search_document_id_sorted(core="", document_id=""):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
-    search = get_results(client.search(
-        'attr_document_id:"' + document_id + '"', **{'rows': ROW_LIMIT, 'sort': QUERY_ID_ASC}))
-    return search
-
-
-def get_results(response):
-    results = []
-    for doc in response:
-        results.append(doc)
-    return results
+    return solr_search_cursor(core, query, fl=fl, sort=QUERY_ID_ASC)
+
+
+def solr_search_document_id_sorted(core="", document_id="", fl=None):
+    return solr_search_cursor(core, 'attr_document_id:"' + document_id + '"', fl=fl, sort=QUERY_ID_ASC)
+
+
+def solr_search_cursor(core="", term="", fl=None, rows=SOLR_PAGE_SIZE, **kwargs):
+    """
+    Lazily iterate over all documents matching term, paging with cursorMark.
+    Only one page of results is held in memory at a time.
+    """
+    for response in solr_search_pages(core, term, fl=fl, rows=rows, **kwargs):
+        yield from response.docs
+
+
+def solr_search_pages(core="", term="", fl=None, rows=SOLR_PAGE_SIZE, **kwargs):
+    """
+    Lazily iterate over the result pages (pysolr Results) of a query, paging with cursorMark.
+    """
+    client = get_solr(core)
+    options = dict(kwargs)
+    options['rows'] = rows
+    # cursorMark requires a sort on the uniqueKey field
+    options.setdefault('sort', QUERY_ID_ASC)
+    if fl:
+        options['fl'] = fl
+    cursor_mark = '*'
+    while True:
+        options['cursorMark'] = cursor_mark
+        response = client.search(term, **options)
+        yield response
+        if not response.docs or response.nextCursorMark in (None, cursor_mark):
+            break
+        cursor_mark = response.nextCursorMark
 
 
 def get_results_highlighted(response):
@@ -270,7 +294,7 @@ def get_results_highlighted_preanalyzed(response):
 
 
 def solr_update(core, document):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     document_existing_result = client.search('id:' + str(document['id']))
     if len(document_existing_result.docs) == 1:
         document_existing = document_existing_result.docs[0]
@@ -279,13 +303,13 @@ def solr_update(core, document):
                 document_existing[key] = value.name
             elif key != 'id':
                 document_existing[key] = value
-        client.add([document_existing], commit=True)
-    else:
-        client.add([document], commit=True)
+        document = document_existing
+    with SolrWriter(core) as writer:
+        writer.add(document)
 
 
 def solr_add_file(core, file, file_id, file_url, document_id):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     extra_params = {
         'commit': 'true',
         'literal.id': file_id,
@@ -298,7 +322,7 @@ def solr_add_file(core, file, file_id, file_url, document_id):
 
 def solr_delete(core, id):
     try:
-        client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+        client = get_solr(core)
         client.delete(id=id)
         client.commit()
     except pysolr.SolrError:
@@ -313,7 +337,7 @@ upon which a threshold can be applied: see https://www.dexstr.io/finding-duplica
 
 
 def solr_mlt(core, id, mlt_field='title,content', number_candidates=5, threshold=0.0):
-    client = pysolr.Solr(os.environ['SOLR_URL'] + '/' + core)
+    client = get_solr(core)
     search_result = client.search('id:' + id, **{'mlt': 'true',
                                                  'mlt.fl': mlt_field,
                                                  'mlt.count': number_candidates,
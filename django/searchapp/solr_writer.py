@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pysolr
+import requests
+
+from searchapp.clients import get_solr_session
+
+logger = logging.getLogger(__name__)
+
+# number of buffered documents that triggers a flush
+SOLR_WRITER_BATCH_SIZE = int(os.environ.get('SOLR_WRITER_BATCH_SIZE', 1000))
+# approximate size of the buffered JSON that triggers a flush
+SOLR_WRITER_MAX_BYTES = int(os.environ.get('SOLR_WRITER_MAX_BYTES', 8 * 1024 * 1024))
+# seconds a buffered update may wait before it is flushed
+SOLR_WRITER_MAX_AGE = float(os.environ.get('SOLR_WRITER_MAX_AGE', 10))
+# milliseconds within which Solr makes flushed updates visible, instead of hard commits
+SOLR_COMMIT_WITHIN = int(os.environ.get('SOLR_COMMIT_WITHIN', 15000))
+
+ATOMIC_SET = 'set'
+
+
+def is_atomic_update(doc):
+    return any(isinstance(value, dict) for key, value in doc.items() if key != 'id')
+
+
+def is_set_update(value):
+    return isinstance(value, dict) and list(value) == [ATOMIC_SET]
+
+
+class SolrWriter:
+    """
+    Buffers Solr updates and sends them in batches with commitWithin instead of hard commits.
+    Several updates for the same id are merged into one document before they are sent.
+    The buffer is flushed when it reaches batch_size documents or max_bytes of JSON, when the
+    oldest update is older than max_age seconds, or when the writer is closed. Safe to share
+    between threads. Use commit() at the end of a stage when the next stage has to search the
+    updates, it opens a new searcher with a soft commit.
+    A failed flush raises and keeps the documents buffered for the next flush, unless on_error is given:
+    then the documents of the failed batch are sent one by one and on_error(doc_id, error) is called
+    for every document Solr rejects.
+    """
+
+    def __init__(self, core='documents', batch_size=SOLR_WRITER_BATCH_SIZE, max_age=SOLR_WRITER_MAX_AGE,
+                 commit_within=SOLR_COMMIT_WITHIN, session=None, max_bytes=SOLR_WRITER_MAX_BYTES, on_error=None):
+        self.core = core
+        self.url = os.environ['SOLR_URL'] + '/' + core + '/update'
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.commit_within = commit_within
+        self.session = session or get_solr_session()
+        self.on_error = on_error
+        self._buffer = {}
+        self._bytes = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+
+    def add(self, docs):
+        """
+        Buffer a document, an atomic update ({"id": .., "field": {"set": ..}}) or a list of them.
+        """
+        if isinstance(docs, dict):
+            docs = [docs]
+        with self._lock:
+            for doc in docs:
+                self._buffer_doc(doc)
+                # merged updates are counted twice, the estimate only has to bound the request size
+                self._bytes += len(json.dumps(doc))
+            if len(self._buffer) >= self.batch_size or self._bytes >= self.max_bytes or self._expired():
+                self.flush()
+
+    def set_fields(self, doc_id, **fields):
+        """
+        Buffer an atomic update that sets the given fields.
+        """
+        doc = {key: {ATOMIC_SET: value} for key, value in fields.items()}
+        doc['id'] = str(doc_id)
+        self.add(doc)
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            docs = list(self._buffer.values())
+            self._buffer = {}
+            self._bytes = 0
+            self._oldest = None
+            logger.info("Posting %d documents to SOLR core '%s'", len(docs), self.core)
+            # pysolr drops commitWithin for JSON updates, so post the JSON update ourselves
+            try:
+                self._post({'commitWithin': self.commit_within}, json.dumps(docs))
+            except (pysolr.SolrError, requests.RequestException) as err:
+                if self.on_error is None:
+                    # keep the documents, they are sent again with the next flush
+                    self._restore(docs)
+                    raise
+                self._post_each(docs, err)
+
+    def commit(self):
+        """
+        Flush and make all updates searchable with a soft commit.
+        """
+        with self._lock:
+            self.flush()
+            self._post({'softCommit': 'true'}, '[]')
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _post(self, params, data):
+        response = self.session.post(self.url, params=params, data=data.encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+        if response.status_code != 200:
+            raise pysolr.SolrError("Solr update failed (HTTP %s): %s" % (response.status_code, response.text))
+
+    def _post_each(self, docs, err):
+        if len(docs) == 1:
+            logger.error("Solr update of document %s failed: %s", docs[0]['id'], err)
+            self.on_error(docs[0]['id'], err)
+            return
+        logger.warning("Solr update of %d documents failed (%s), posting them one by one", len(docs), err)
+        for doc in docs:
+            try:
+                self._post({'commitWithin': self.commit_within}, json.dumps([doc]))
+            except (pysolr.SolrError, requests.RequestException) as doc_err:
+                logger.error("Solr update of document %s failed: %s", doc['id'], doc_err)
+                self.on_error(doc['id'], doc_err)
+
+    def _restore(self, docs):
+        # the lock is held since the buffer was taken, so nothing was buffered in between
+        for doc in docs:
+            self._buffer[doc['id']] = doc
+        self._bytes = sum(len(json.dumps(doc)) for doc in docs)
+        self._oldest = time.monotonic()
+
+    def _expired(self):
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+
+    def _buffer_doc(self, doc):
+        doc_id = str(doc['id'])
+        buffered = self._buffer.get(doc_id)
+        if buffered is None:
+            self._buffer[doc_id] = dict(doc, id=doc_id)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            return
+        merged = merge_updates(buffered, doc)
+        if merged is None:
+            # updates can't be combined, send what we have so the order is kept
+            self.flush()
+            self._buffer_doc(doc)
+        else:
+            self._buffer[doc_id] = merged
+
+
+def merge_updates(buffered, doc):
+    """
+    Merge doc into an update that is already buffered for the same id.
+    Returns None when the two can't be combined into a single document.
+    """
+    if not is_atomic_update(doc):
+        # a full document replaces everything sent before
+        return dict(doc, id=buffered['id'])
+    merged = dict(buffered)
+    buffered_atomic = is_atomic_update(buffered)
+    for key, value in doc.items():
+        if key == 'id':
+            continue
+        if buffered_atomic:
+            if key in merged and not (is_set_update(value) and is_set_update(merged[key])):
+                # e.g. two "add" modifiers for the same field
+                return None
+            merged[key] = value
+        elif is_set_update(value):
+            # setting a field of a full document
+            merged[key] = value[ATOMIC_SET]
+        elif not isinstance(value, dict):
+            merged[key] = value
+        else:
+            return None
+    return merged
@@ -133,6 +133,10 @@ urlpatterns = [
     path('api/export/download/<task_id>',
          views.ExportDocumentsDownload.as_view(), name='export_download_api'),
 
+    # Pipeline runs
+    path('api/pipeline-runs', views.PipelineRunListAPIView.as_view(),
+         name='pipeline_run_list_api'),
+
     # Bookmarks
     path('api/bookmarks', views.BookmarkListAPIView.as_view(),
          name='bookmark_list_api'),
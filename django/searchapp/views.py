@@ -1,17 +1,18 @@
 import logging
 import os
 import re
+import uuid
 
-import requests
 from celery.result import AsyncResult
 from django.db.models import Q, Count
 from django.db.models.functions import Length
 from django.http import FileResponse
 from lxml import html
-from minio import Minio
 from rest_framework import permissions, filters
 from rest_framework import status
-from rest_framework.generics import RetrieveUpdateDestroyAPIView, ListCreateAPIView, RetrieveUpdateAPIView
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import RetrieveUpdateDestroyAPIView, ListCreateAPIView, RetrieveUpdateAPIView, \
+    ListAPIView
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -19,10 +20,12 @@ from rest_framework.views import APIView
 from glossary.models import Concept, ConceptOccurs, ConceptDefined, AcceptanceStateValue
 from scheduler.tasks import export_documents, sync_documents_task, score_documents_task
 from scheduler.tasks_single import full_service_single
-from .models import Website, Document, Attachment, AcceptanceState, AcceptanceStateValue, Comment, Tag, Bookmark
+from .clients import get_minio, get_http_session
+from .models import Website, Document, Attachment, AcceptanceState, AcceptanceStateValue, Comment, Tag, Bookmark, \
+    PipelineRun
 from .permissions import IsOwner, IsOwnerOrSuperUser
 from .serializers import AttachmentSerializer, DocumentSerializer, WebsiteSerializer, AcceptanceStateSerializer, \
-    CommentSerializer, TagSerializer, BookmarkSerializer
+    CommentSerializer, TagSerializer, BookmarkSerializer, PipelineRunSerializer
 from .solr_call import solr_search_id, solr_search_paginated, solr_mlt, \
     solr_search_query_paginated_preanalyzed, solr_search_ids, solr_get_preanalyzed_for_doc, \
     solr_search_query_with_doc_id_preanalyzed, solr_search_website_paginated
@@ -185,8 +188,8 @@ class DocumentDetailAPIView(RetrieveUpdateDestroyAPIView):
         document = Document.objects.get(pk=self.kwargs['pk'])
         with_content = self.request.GET.get('with_content', False)
         if with_content:
-            solr_doc = solr_search_id(
-                core='documents', id=str(self.kwargs['pk']))[0]
+            solr_doc = next(solr_search_id(
+                core='documents', id=str(self.kwargs['pk']), fl='content,content_html'))
             # Content is a virtual field (see serializer)
             if 'content' in solr_doc and len(solr_doc['content']) > 0:
                 document.content = solr_doc['content'][0]
@@ -208,8 +211,8 @@ class AttachmentDetailAPIView(RetrieveUpdateDestroyAPIView):
         # Read content from document
         queryset = self.get_queryset()
         attachment = Attachment
-        solr_doc = solr_search_id(
-            core='document', id=str(self.kwargs['pk']))[0]
+        solr_doc = next(solr_search_id(
+            core='document', id=str(self.kwargs['pk']), fl='content'))
         attachment.content = solr_doc['content']
         return attachment
 
@@ -295,7 +298,7 @@ class SolrDocument(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, id, format=None):
-        solr_document = solr_search_id(core='documents', id=id)
+        solr_document = list(solr_search_id(core='documents', id=id))
         return Response(solr_document)
 
 
@@ -405,7 +408,7 @@ class FormexActAPIView(APIView):
         formex_act = ''
         formex_links = get_formex_urls(celex)
         if len(formex_links) > 1:
-            act_response = requests.get(formex_links[1])
+            act_response = get_http_session('cellar').get(formex_links[1])
             if act_response.status_code == 200:
                 formex_act = act_response.content
         return Response(formex_act)
@@ -415,7 +418,7 @@ def get_formex_urls(celex):
     cellar_api = 'http://publications.europa.eu/resource/celex/'
     headers = {'Accept': 'application/list;mtype=fmx4',
                'Accept-Language': 'eng'}
-    response = requests.get(cellar_api + celex, headers=headers)
+    response = get_http_session('cellar').get(cellar_api + celex, headers=headers)
     formex_links = []
     if response.status_code == 200:
         html_content = response.content
@@ -462,8 +465,7 @@ class ExportDocumentsDownload(APIView):
 
     def get(self, request, task_id, format=None):
         # get zip for given task id from minio
-        minio_client = Minio('minio:9000', access_key=os.environ['MINIO_ACCESS_KEY'],
-                             secret_key=os.environ['MINIO_SECRET_KEY'], secure=False)
+        minio_client = get_minio()
         file = minio_client.get_object('export', task_id + '.zip')
         response = FileResponse(file, as_attachment=True)
         response['Content-Disposition'] = 'attachment; filename="%s"' % 'exported_docs.zip'
@@ -531,6 +533,31 @@ class BookmarkListAPIView(ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+class PipelineRunListAPIView(ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = PipelineRunSerializer
+    pagination_class = StandardResultsSetPagination
+
+    def get_queryset(self):
+        queryset = PipelineRun.objects.all()
+        website = self.request.GET.get('website')
+        run_id = self.request.GET.get('run_id')
+        stage = self.request.GET.get('stage')
+        if website:
+            if not website.isdigit():
+                raise ValidationError({'website': 'A website id is required.'})
+            queryset = queryset.filter(website_id=website)
+        if run_id:
+            try:
+                run_id = uuid.UUID(run_id)
+            except ValueError:
+                raise ValidationError({'run_id': 'A valid UUID is required.'})
+            queryset = queryset.filter(run_id=run_id)
+        if stage:
+            queryset = queryset.filter(stage=stage)
+        return queryset
+
+
 class CelexListAPIView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 